@@ -0,0 +1,70 @@
+"""In-process arena that plays student agents against the game engine."""
+import argparse
+import logging
+import time
+
+from game import Game, run_headless
+from student import Agent
+
+logger = logging.getLogger("Arena")
+logger.setLevel(logging.INFO)
+
+
+class ArenaPlayer:
+    """Drive a student Agent with the states the server would send."""
+
+    def __init__(self, game_info, name, **agent_options):
+        self.agent = Agent(game_info, name, **agent_options)
+        self.crashed = False
+
+    def __call__(self, state):
+        if self.crashed:
+            return None
+        try:
+            return self.agent.decide(state)
+        except Exception as err:
+            # the networked agent stops sending keys once its loop breaks
+            logger.error("Agent <%s> stopped: %s", self.agent.name, err)
+            self.crashed = True
+            return None
+
+
+def play(names, agent_options=None, **game_kwargs):
+    """Play one game between student agents and return the finished Game.
+
+    agent_options are passed to every player's Agent.
+    """
+    game = Game(**game_kwargs)
+    game.start(list(names))
+    game_info = game.info()  # with the initial food, as the server sends it
+    agents = {
+        name: ArenaPlayer(game_info, name, **(agent_options or {}))
+        for name in names
+    }
+    return run_headless(agents, game=game)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    # per-frame engine logging would dominate the run time
+    logging.getLogger("Game").setLevel(logging.WARNING)
+    logging.getLogger("Map").setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", help="Number of players", type=int, default=1)
+    parser.add_argument("--games", help="Number of games", type=int, default=1)
+    args = parser.parse_args()
+
+    names = [f"agent{i}" for i in range(args.players)]
+    for i in range(args.games):
+        start = time.perf_counter()
+        game = play(names)
+        logger.info(
+            "Game %s: %s steps in %.2fs, scores %s",
+            i,
+            game._step,
+            time.perf_counter() - start,
+            {name: snake.score for name, snake in game.snakes.items()},
+        )
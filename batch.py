@@ -0,0 +1,397 @@
+"""Vectorized engine stepping many single-snake games in lockstep.
+
+Every game of the batch is a regular Game started with one player, whose
+state is then moved into stacked NumPy arrays. Movement, wrap-around,
+collisions and growth are applied to the whole batch at once; the rare
+events (eating, super food, deaths) are resolved per game with the game's
+own random generator, so the batch follows exactly the same rules and
+random draws as the scalar Game.
+"""
+import argparse
+import logging
+import random
+import time
+
+import numpy as np
+
+from consts import TIMEOUT, SuperFood, Tiles
+from game import MAP_SIZE, Game, key2direction
+
+logger = logging.getLogger("Batch")
+logger.setLevel(logging.INFO)
+
+NO_KEY = -1  # keep the last key pressed, as when a player sends nothing
+KEY_CODES = {"": 0, "w": 1, "a": 2, "s": 3, "d": 4}  # anything else is 0 too
+
+# direction of each key code, -1 keeps the current direction
+KEY_DIRECTION = np.array([-1, 0, 3, 2, 1])
+# (dx, dy) of each Direction value
+DIRECTION_DELTA = np.array([(0, -1), (1, 0), (0, 1), (-1, 0)])
+
+SUPER_FOODS = [SuperFood.POINTS, SuperFood.LENGTH, SuperFood.RANGE, SuperFood.TRAVERSE]
+
+
+def encode_keys(keys):
+    """Turn a list of keys (str or None) into the codes taken by step()."""
+    return np.array(
+        [NO_KEY if key is None else KEY_CODES.get(key, 0) for key in keys]
+    )
+
+
+def _discard(cells, index, count, games, cell_ids):
+    """FreeCells.discard on each (game, cell) pair."""
+    i = index[games, cell_ids]
+    found = i >= 0
+    games, cell_ids, i = games[found], cell_ids[found], i[found]
+    count[games] -= 1
+    last = cells[games, count[games]]
+    cells[games, i] = last
+    index[games, last] = i
+    index[games, cell_ids] = -1
+
+
+def _add(cells, index, count, games, cell_ids):
+    """FreeCells.add on each (game, cell) pair."""
+    new = index[games, cell_ids] < 0
+    games, cell_ids = games[new], cell_ids[new]
+    cells[games, count[games]] = cell_ids
+    index[games, cell_ids] = count[games]
+    count[games] += 1
+
+
+class BatchGame:
+    """Many single-snake games stored as arrays and stepped together."""
+
+    def __init__(self, seeds, timeout=TIMEOUT, size=MAP_SIZE, player="player"):
+        self.size = size
+        self.timeout = timeout
+        self.player = player
+        width, height = size
+        cells = width * height
+        n = len(seeds)
+
+        games = []
+        for seed in seeds:
+            game = Game(seed=seed, timeout=timeout, size=size)
+            game.start([player])
+            games.append(game)
+        self._rngs = [game._rng for game in games]
+
+        self.grid = np.array([game.map.export() for game in games], dtype=np.uint8)
+        self.nests = np.zeros((n, width, height), dtype=bool)
+        self.occupied = np.zeros((n, width, height), dtype=bool)
+        self.food = [list(game.map._food) for game in games]
+
+        # free cells and spawnable cells, mirroring Map's FreeCells indexes
+        self._free = self._index_arrays(n, cells)
+        self._spawnable = self._index_arrays(n, cells)
+
+        # snake bodies in a ring buffer, from tail to head
+        self.body = np.zeros((n, cells, 2), dtype=np.int16)
+        self.tail = np.zeros(n, dtype=np.int64)
+        self.length = np.ones(n, dtype=np.int64)
+
+        self.step_count = np.zeros(n, dtype=np.int64)
+        self.running = np.ones(n, dtype=bool)
+        self.alive = np.ones(n, dtype=bool)
+        self.direction = np.zeros(n, dtype=np.int64)
+        self.lastkey = np.zeros(n, dtype=np.int64)
+        self.to_grow = np.zeros(n, dtype=np.int64)
+        self.score = np.zeros(n, dtype=np.int64)
+        self.range = np.zeros(n, dtype=np.int64)
+        self.traverse = np.zeros(n, dtype=bool)
+        self.died_at = np.full(n, -1, dtype=np.int64)
+        self.death_cause = [None] * n
+
+        for g, game in enumerate(games):
+            snake = game.snakes[player]
+            self.body[g, 0] = snake.head
+            self.occupied[g][snake.head] = True
+            self.direction[g] = snake.direction
+            self.to_grow[g] = snake.to_grow
+            self.score[g] = snake.score
+            self.range[g] = snake.range
+            self.traverse[g] = snake._traverse
+            for x, y in game.map._snake_nests:
+                self.nests[g, x, y] = True
+            for arrays, free_cells in (
+                (self._free, game.map._free),
+                (self._spawnable, game.map._spawnable),
+            ):
+                ids = [x * height + y for x, y in free_cells._cells]
+                arrays[0][g, : len(ids)] = ids
+                arrays[1][g, ids] = np.arange(len(ids))
+                arrays[2][g] = len(ids)
+
+    @staticmethod
+    def _index_arrays(n, cells):
+        return (
+            np.zeros((n, cells), dtype=np.int64),  # cells
+            np.full((n, cells), -1, dtype=np.int64),  # index
+            np.zeros(n, dtype=np.int64),  # count
+        )
+
+    def __len__(self):
+        return len(self.running)
+
+    @property
+    def heads(self):
+        """Head position of every snake, shape (N, 2)."""
+        head = (self.tail + self.length - 1) % self.body.shape[1]
+        return self.body[np.arange(len(self)), head].astype(np.int64)
+
+    def snake_body(self, g):
+        """Body of game g as a list of cells, from tail to head."""
+        slots = (self.tail[g] + np.arange(self.length[g])) % self.body.shape[1]
+        return [tuple(cell) for cell in self.body[g, slots].tolist()]
+
+    ##########################################################
+    #                 Free cell bookkeeping                  #
+    ##########################################################
+
+    def _cell_ids(self, xs, ys):
+        return xs * self.size[1] + ys
+
+    def _occupy(self, games, xs, ys):
+        """Map.occupy for each game."""
+        ids = self._cell_ids(xs, ys)
+        self.occupied[games, xs, ys] = True
+        _discard(*self._free, games, ids)
+        _discard(*self._spawnable, games, ids)
+
+    def _release_cells(self, games, xs, ys):
+        """Map._release_cell for each game."""
+        ids = self._cell_ids(xs, ys)
+        _add(*self._free, games, ids)
+        outside = ~self.nests[games, xs, ys]
+        _add(*self._spawnable, games[outside], ids[outside])
+
+    def _release(self, games, xs, ys):
+        """Map.release for each game."""
+        self.occupied[games, xs, ys] = False
+        passage = self.grid[games, xs, ys] == Tiles.PASSAGE
+        self._release_cells(games[passage], xs[passage], ys[passage])
+
+    def _pop(self, games):
+        slots = self.tail[games]
+        xs = self.body[games, slots, 0].astype(np.int64)
+        ys = self.body[games, slots, 1].astype(np.int64)
+        self.tail[games] = (slots + 1) % self.body.shape[1]
+        self.length[games] -= 1
+        self._release(games, xs, ys)
+
+    ##########################################################
+    #                Per game (rare) events                  #
+    ##########################################################
+
+    def _kill(self, g, cause):
+        if self.alive[g]:
+            # dead snakes are no longer obstacles
+            for x, y in self.snake_body(g):
+                self._release(np.array([g]), np.array([x]), np.array([y]))
+        self.alive[g] = False
+        self.death_cause[g] = cause
+        self.died_at[g] = self.step_count[g]
+
+    def _spawn_food(self, g, food_type=Tiles.FOOD):
+        cells, _, count = self._free
+        if not count[g]:
+            logger.warning("No free cell left to spawn food")
+            return
+        cell = int(cells[g, self._rngs[g].randrange(count[g])])
+        x, y = divmod(cell, self.size[1])
+        games, ids = np.array([g]), np.array([cell])
+        _discard(*self._free, games, ids)
+        _discard(*self._spawnable, games, ids)
+        self.grid[g, x, y] = food_type
+        self.food[g].append((x, y))
+
+    def _grow(self, g, amount=1):
+        self.to_grow[g] = max(-self.length[g] + 1, self.to_grow[g] + amount)
+
+    def _eat(self, g, x, y):
+        rng = self._rngs[g]
+        what_i_ate = self.grid[g, x, y]
+        self.grid[g, x, y] = Tiles.PASSAGE
+        self.food[g].remove((x, y))
+        if not self.occupied[g, x, y]:
+            self._release_cells(np.array([g]), np.array([x]), np.array([y]))
+
+        if what_i_ate == Tiles.FOOD:
+            self.score[g] += 1
+            self._grow(g)
+            self._spawn_food(g)
+        elif what_i_ate == Tiles.SUPER:
+            kind = rng.choice(SUPER_FOODS)
+            if kind == SuperFood.POINTS:
+                self.score[g] += rng.randint(-5, 10)
+            elif kind == SuperFood.LENGTH:
+                self._grow(g, rng.randint(-2, 2))
+            elif kind == SuperFood.RANGE:
+                self.range[g] = min(max(self.range[g] + rng.randint(-2, 2), 2), 6)
+            elif kind == SuperFood.TRAVERSE:
+                self.traverse[g] = not self.traverse[g]
+
+    ##########################################################
+    #                         Step                           #
+    ##########################################################
+
+    def step(self, keys=None):
+        """Advance every running game by one frame, as Game.step does.
+
+        keys is an array of key codes (see encode_keys), NO_KEY keeps the
+        key last pressed in that game.
+        """
+        width, height = self.size
+
+        if keys is not None:
+            keys = np.asarray(keys)
+            pressed = keys != NO_KEY
+            self.lastkey[pressed] = keys[pressed]
+
+        started = self.running.copy()
+        self.step_count[started] += 1
+        self.running &= self.step_count != self.timeout
+
+        for g in np.flatnonzero(started & (self.step_count % 100 == 0)):
+            self._spawn_food(g, Tiles.SUPER)
+
+        # move every live snake
+        moving = np.flatnonzero(started & self.alive)
+        key_direction = KEY_DIRECTION[self.lastkey[moving]]
+        direction = np.where(key_direction >= 0, key_direction, self.direction[moving])
+        heads = self.heads[moving]
+        new = heads + DIRECTION_DELTA[direction]
+        traverse = self.traverse[moving]
+        new[traverse, 0] %= width
+        new[traverse, 1] %= height
+
+        inside = (
+            (new[:, 0] >= 0) & (new[:, 0] < width) & (new[:, 1] >= 0) & (new[:, 1] < height)
+        )
+        xs = np.where(inside, new[:, 0], 0)
+        ys = np.where(inside, new[:, 1], 0)
+        blocked = ~inside | (~traverse & (self.grid[moving, xs, ys] == Tiles.STONE))
+        crashed = ~blocked & self.occupied[moving, xs, ys]
+
+        for g in moving[blocked]:
+            self._kill(g, "wall")
+        for g in moving[crashed]:
+            self._kill(g, "self")
+
+        ok = ~(blocked | crashed)
+        games, xs, ys = moving[ok], xs[ok], ys[ok]
+        self.direction[games] = direction[ok]
+
+        # push the new head
+        slots = (self.tail[games] + self.length[games]) % self.body.shape[1]
+        self.body[games, slots, 0] = xs
+        self.body[games, slots, 1] = ys
+        self.length[games] += 1
+        self._occupy(games, xs, ys)
+
+        # then pop the tail unless growing, twice when shrinking
+        growing = self.to_grow[games] > 0
+        shrinking = ~growing & (self.to_grow[games] < 0) & (self.length[games] > 3)
+        self.to_grow[games[growing]] -= 1
+        self.to_grow[games[shrinking]] += 1
+        self._pop(games[~growing])
+        self._pop(games[shrinking])
+
+        # collisions only happen while the game is running
+        colliding = np.flatnonzero(self.running & self.alive)
+        heads = self.heads[colliding]
+        hx, hy = heads[:, 0], heads[:, 1]
+        tiles = self.grid[colliding, hx, hy]
+        for g in colliding[(tiles == Tiles.STONE) & ~self.traverse[colliding]]:
+            self._kill(g, "stone")
+        eating = (tiles == Tiles.FOOD) | (tiles == Tiles.SUPER)
+        for g, x, y in zip(colliding[eating], hx[eating], hy[eating]):
+            self._eat(g, x, y)
+
+        self.running &= self.alive
+
+
+def _reference_key(game, name, rng):
+    """Random key that mostly avoids crashing, to keep checked games long."""
+    snake = game.snakes[name]
+    safe = [
+        key
+        for key in "wasd"
+        if (pos := game.map.calc_pos(snake.head, key2direction(key), snake._traverse))
+        != snake.head
+        and not snake.collision(pos)
+    ]
+    if safe and rng.random() < 0.99:
+        return rng.choice(safe)
+    return rng.choice(["w", "a", "s", "d", "", "x", None])
+
+
+def _check(seeds, timeout):
+    """Play the same seeds and keys on Game and BatchGame, compare each frame."""
+    batch = BatchGame(seeds, timeout=timeout)
+    games = []
+    for seed in seeds:
+        game = Game(seed=seed, timeout=timeout)
+        game.start([batch.player])
+        games.append(game)
+    players = [random.Random(seed) for seed in seeds]
+
+    for _ in range(timeout):
+        keys = [
+            _reference_key(game, batch.player, rng) if game.running else None
+            for game, rng in zip(games, players)
+        ]
+        batch.step(encode_keys(keys))
+        for g, (game, key) in enumerate(zip(games, keys)):
+            game.step({batch.player: key})
+            snake = game.snakes[batch.player]
+            expected = (
+                game.running, snake.alive, snake.score, snake.range,
+                snake._traverse, snake.body, game.map._food, snake.death_cause,
+            )
+            got = (
+                bool(batch.running[g]), bool(batch.alive[g]), int(batch.score[g]),
+                int(batch.range[g]), bool(batch.traverse[g]), batch.snake_body(g),
+                batch.food[g], batch.death_cause[g],
+            )
+            if expected != got:
+                raise AssertionError(
+                    f"seed {seeds[g]} differs at step {game._step}: {expected} != {got}"
+                )
+        if not batch.running.any():
+            break
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    logging.getLogger("Game").setLevel(logging.WARNING)
+    logging.getLogger("Map").setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", help="Number of games", type=int, default=1000)
+    parser.add_argument("--timeout", help="Steps per game", type=int, default=TIMEOUT)
+    parser.add_argument(
+        "--check", help="Compare against the scalar Game", action="store_true"
+    )
+    args = parser.parse_args()
+    seeds = list(range(1, args.games + 1))
+
+    if args.check:
+        _check(seeds, args.timeout)
+        logger.info("BatchGame matches Game on %s seeds", len(seeds))
+    else:
+        batch = BatchGame(seeds, timeout=args.timeout)
+        rng = np.random.default_rng(0)
+        start = time.perf_counter()
+        frames = 0
+        direction_key = np.array([KEY_CODES[key] for key in "wdsa"])
+        while batch.running.any():
+            # random turns, never straight back into the neck
+            turn = rng.choice([-1, 0, 0, 0, 1], size=len(batch))
+            batch.step(direction_key[(batch.direction + turn) % 4])
+            frames += int(batch.running.sum())
+        elapsed = time.perf_counter() - start
+        logger.info("%s frames in %.2fs (%.0f frames/s)", frames, elapsed, frames / elapsed)
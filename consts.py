@@ -12,6 +12,8 @@ NEST_SIZE = 3
 
 TIMEOUT = 3000
 
+MATCH_PREFIX = "match-"  # names of the rooms formed by matchmakers
+
 
 class Tiles(IntEnum):
     PASSAGE = 0
@@ -1,10 +1,12 @@
 import asyncio
 import logging
 import random
-from collections import deque
+from collections import Counter, deque
+from itertools import islice
+from time import perf_counter
 
 from consts import KILL_SNAKE_POINTS, TIMEOUT, Direction, HISTORY_LEN, Tiles, SuperFood
-from mapa import Map
+from mapa import Map, rollback
 
 logger = logging.getLogger("Game")
 logger.setLevel(logging.DEBUG)
@@ -14,29 +16,162 @@ GAME_SPEED = 10
 MAP_SIZE = (48, 24)
 FOOD_IN_MAP = 4
 
+class TickScheduler:
+    """Wake up at absolute tick deadlines on the event loop clock.
+
+    Time spent between two waits (simulation, serialization, sends) is taken
+    out of the next sleep, so the tick period does not drift with load.
+    advance() ends the current tick early, the next one then starts from now.
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.overruns = 0
+        self.last_overrun = 0.0  # seconds the last late tick missed its deadline by
+        self._deadline = None
+        self._advance = asyncio.Event()
+
+    def advance(self):
+        """Let the pending or next wait() return without waiting the deadline."""
+        self._advance.set()
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        if self._deadline is None:
+            self._deadline = now + self.period
+
+        delay = self._deadline - now
+        if self._advance.is_set():
+            self._deadline = now
+        elif delay > 0:
+            try:
+                await asyncio.wait_for(self._advance.wait(), delay)
+                self._deadline = asyncio.get_running_loop().time()
+            except asyncio.TimeoutError:
+                pass
+        else:
+            self.overruns += 1
+            self.last_overrun = -delay
+            logger.warning(
+                "Tick overrun by %.1f ms (%s so far)", -delay * 1000, self.overruns
+            )
+            # skip the ticks we missed instead of bursting to catch up
+            self._deadline += (-delay // self.period) * self.period
+        self._advance.clear()
+        self._deadline += self.period
+
+
+class GameRandom(random.Random):
+    """Random generator of a game that can record its state in an undo log.
+
+    While a journal is set, the state is saved before the first draw that
+    follows a snapshot, so snapshots do not pay for copying it.
+    """
+
+    def __init__(self, seed=None):
+        super().__init__(seed)
+        self.journal = None
+        self.saved = False  # state already saved since the last snapshot
+
+    def _save(self):
+        if self.journal is not None and not self.saved:
+            self.journal.append((self._restore_state, self.getstate()))
+            self.saved = True
+
+    def _restore_state(self, state):
+        self.setstate(state)
+
+    def random(self):
+        self._save()
+        return super().random()
+
+    def getrandbits(self, k):
+        self._save()
+        return super().getrandbits(k)
+
+
+class Occupancy:
+    """Cells taken by live snakes, shared by all the snakes of a game.
+
+    When given a map, it is told which cells snakes take and leave so it
+    does not spawn anything on top of them.
+    """
+
+    def __init__(self, mapa=None):
+        self._owners = {}  # cell -> names of the snakes in it
+        self._map = mapa
+        self._journal = None  # undo log, see Game.snapshot
+
+    def add(self, pos, name):
+        if pos not in self._owners:
+            self._owners[pos] = set()
+            if self._map is not None:
+                self._map.occupy(pos)
+        if name not in self._owners[pos]:
+            self._owners[pos].add(name)
+            if self._journal is not None:
+                self._journal.append((self._undo_add, pos, name))
+
+    def _undo_add(self, pos, name):
+        self._owners[pos].discard(name)
+        if not self._owners[pos]:
+            del self._owners[pos]
+
+    def discard(self, pos, name):
+        owners = self._owners.get(pos)
+        if owners is None or name not in owners:
+            return
+        owners.discard(name)
+        if self._journal is not None:
+            self._journal.append((self._undo_discard, pos, name))
+        if not owners:
+            del self._owners[pos]
+            if self._map is not None:
+                self._map.release(pos)
+
+    def _undo_discard(self, pos, name):
+        self._owners.setdefault(pos, set()).add(name)
+
+    def owners(self, pos):
+        return self._owners.get(pos, ())
+
+    def __contains__(self, pos):
+        return pos in self._owners
+
+
 class Snake:
-    def __init__(self, player_name, x=1, y=1):
+    def __init__(self, player_name, x=1, y=1, occupancy=None):
         self._name = player_name
-        self._body = [(x, y)]
+        self._body = deque([(x, y)])
+        self._cells = Counter(self._body)  # multiset of the cells in _body
+        self._journal = None  # undo log of body changes, see snapshot()
+        self._occupancy = occupancy if occupancy is not None else Occupancy()
+        self._occupancy.add((x, y), player_name)
         self._spawn_pos = (x, y)
         self._direction: Direction = Direction.EAST
         self._history = deque(maxlen=HISTORY_LEN)
         self._score = 0
         self._traverse = True  # if True, the snake can traverse stones
         self._alive = True
+        self.death_cause = None
+        self.died_at = None  # step of death, set by the Game
         self.lastkey = ""
         self.to_grow = 1
         self.range = 3
 
-    def sight(self, mapa, snakes):
+    def sight(self, mapa, snakes=None):
+        """Tiles in range of the head, with every live snake marked.
+
+        snakes is kept for compatibility, the live snakes are looked up in the
+        occupancy grid shared by the game.
+        """
         in_range = mapa.get_zone(self.head, self.range)
 
-        for snake in snakes:  # mark all snakes in the map
-            if not snake.alive:
-                continue  # ignore dead snakes
-            for x, y in snake.body:
-                if x in in_range and y in in_range[x]:
-                    in_range[x][y] = Tiles.SNAKE
+        occupancy = self._occupancy
+        for x, column in in_range.items():
+            for y in column:
+                if (x, y) in occupancy:
+                    column[y] = Tiles.SNAKE
 
         return in_range
 
@@ -50,18 +185,88 @@ class Snake:
 
     @property
     def tail(self):
-        return self._body[:-1]
+        return list(islice(self._body, len(self._body) - 1))
 
     @property
     def body(self):
-        return self._body
+        return list(self._body)
+
+    def _push(self, pos):
+        self._body.append(pos)
+        if not self._cells[pos]:
+            self._occupancy.add(pos, self._name)
+        self._cells[pos] += 1
+        if self._journal is not None:
+            self._journal.append((self._undo_push,))
+
+    def _undo_push(self):
+        pos = self._body.pop()
+        self._cells[pos] -= 1
+        if not self._cells[pos]:
+            del self._cells[pos]
+
+    def _pop(self):
+        pos = self._body.popleft()
+        self._cells[pos] -= 1
+        if not self._cells[pos]:
+            del self._cells[pos]
+            self._occupancy.discard(pos, self._name)
+        if self._journal is not None:
+            self._journal.append((self._undo_pop, pos))
+
+    def _undo_pop(self, pos):
+        self._body.appendleft(pos)
+        self._cells[pos] += 1
+
+    def snapshot(self):
+        """Cheap copy of the snake state, body changes go to the undo log."""
+        if self._journal is None:
+            self._journal = []
+            if self._occupancy._journal is None:
+                self._occupancy._journal = self._journal
+        return (
+            len(self._journal),
+            self._direction,
+            tuple(self._history),
+            self._score,
+            self._traverse,
+            self._alive,
+            self.death_cause,
+            self.died_at,
+            self.lastkey,
+            self.to_grow,
+            self.range,
+        )
+
+    def restore(self, snapshot):
+        """Go back to the state of a snapshot() of this snake."""
+        (
+            mark,
+            self._direction,
+            history,
+            self._score,
+            self._traverse,
+            self._alive,
+            self.death_cause,
+            self.died_at,
+            self.lastkey,
+            self.to_grow,
+            self.range,
+        ) = snapshot
+        self._history = deque(history, maxlen=HISTORY_LEN)
+        rollback(self._journal, mark)
 
     @property
     def alive(self):
         return self._alive
 
-    def kill(self):
+    def kill(self, cause=None):
+        if self._alive:
+            # dead snakes are no longer obstacles
+            for pos in self._body:
+                self._occupancy.discard(pos, self._name)
         self._alive = False
+        self.death_cause = cause
 
     @property
     def name(self):
@@ -101,7 +306,7 @@ class Snake:
 
         new_pos = mapa.calc_pos(self.head, direction, traverse=self._traverse)
 
-        if new_pos == self.head or new_pos in self._body:
+        if new_pos == self.head or new_pos in self._cells:
             # if we can't move to the new position, we crashed against a wall
             # or we are crashing against ourselves
             logger.debug(
@@ -110,24 +315,24 @@ class Snake:
                 new_pos,
                 direction,
             )
-            self.kill()
+            self.kill("wall" if new_pos == self.head else "self")
             return
 
-        self._body.append(new_pos)
+        self._push(new_pos)
         if self.to_grow > 0:  # if we are growing
             self.to_grow -= 1
         elif self.to_grow < 0 and len(self._body) > 3:  # if we are shrinking
             self.to_grow += 1
-            self._body.pop(0)
-            self._body.pop(0)
+            self._pop()
+            self._pop()
         else:  # if we are simply moving
-            self._body.pop(0)
+            self._pop()
 
         self._direction = direction
         self._history.append(new_pos)
 
     def collision(self, pos):
-        return pos in self._body
+        return pos in self._cells
 
     def _calc_dir(self, old_pos, new_pos):
         if old_pos[0] < new_pos[0]:
@@ -159,16 +364,35 @@ def key2direction(key):
 
 
 class Game:
-    def __init__(self, level=1, timeout=TIMEOUT, size=MAP_SIZE, game_speed=GAME_SPEED):
-        logger.info(f"Game(level={level})")
+    def __init__(
+        self,
+        level=1,
+        timeout=TIMEOUT,
+        size=MAP_SIZE,
+        game_speed=GAME_SPEED,
+        seed=None,
+        numpy_grid=False,
+    ):
+        if seed is None:  # pick one, so that every game can be replayed
+            seed = random.randrange(2**32)
+        logger.info(f"Game(level={level}, seed={seed})")
+        self.seed = seed
+        self.recorder = None  # e.g. a replay.ReplayRecorder
+        self.metrics = None  # e.g. a metrics.Histogram labelled by phase
+        self.lockstep = False  # tick as soon as every live snake sent its key
+        self._moved = set()  # players that sent a key for the current step
+        self._rng = GameRandom(seed)  # every game draws from its own generator
         self.initial_level = level
         self._game_speed = game_speed
+        self.scheduler = TickScheduler(1.0 / game_speed)
         self._running = False
         self._timeout = timeout
         self._step = 0
         self._state = {}
         self._snakes = {}
-        self.map = Map(size=size)
+        self.map = Map(size=size, rng=self._rng, numpy_grid=numpy_grid)
+        self._occupancy = Occupancy(self.map)
+        self._journal = None  # undo log shared by map and snakes, see snapshot()
 
     @property
     def snakes(self):
@@ -190,11 +414,17 @@ class Game:
         logger.debug("Reset world")
         self._running = True
         self._snakes = {
-            player_name: Snake(player_name, *self.map.spawn_snake())
+            player_name: Snake(
+                player_name, *self.map.spawn_snake(), occupancy=self._occupancy
+            )
             for player_name in players_names
         }
+        for snake in self._snakes.values():
+            snake._journal = self._journal
         for _ in range(FOOD_IN_MAP):
             self.map.spawn_food()
+        if self.recorder is not None:
+            self.recorder.start(self)
 
     def stop(self):
         logger.info("GAME OVER")
@@ -203,9 +433,23 @@ class Game:
     def quit(self):
         logger.debug("Quit")
         self._running = False
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def keypress(self, player_name, key, step=None):
+        """Set the next move of a player.
 
-    def keypress(self, player_name, key):
+        step is the frame the key answers, a key for an older frame does not
+        count as the move of the current step in lockstep mode.
+        """
         self._snakes[player_name].lastkey = key
+        if step is not None and step != self._step:
+            return
+        self._moved.add(player_name)
+        if self.lockstep and all(
+            name in self._moved for name, snake in self._snakes.items() if snake.alive
+        ):
+            self.scheduler.advance()
 
     def update_snake(self, name):
         try:
@@ -227,12 +471,15 @@ class Game:
             if snake.lastkey in "wasd" and snake.lastkey != ""
             else snake.direction,
         )
+        if not snake.alive:
+            snake.died_at = self._step
 
         return True
 
-    def kill_snake(self, name):
+    def kill_snake(self, name, cause=None):
         logger.info("[step=%s] Snake <%s> has died", self._step, name)
-        self._snakes[name].kill()
+        self._snakes[name].kill(cause)
+        self._snakes[name].died_at = self._step
 
         if all([not snake.alive for snake in self._snakes.values()]):
             # if all snakes are dead, we stop the game
@@ -247,13 +494,11 @@ class Game:
         for name1, snake1 in self._snakes.items():
             if not snake1.alive:
                 continue
-            # check collisions between snakes
-            for name2, snake2 in self._snakes.items():
-                if not snake2.alive:
-                    continue
-                if name1 != name2 and snake2.collision(snake1.head):
-                    self.kill_snake(name1)
-                    snake2.score += KILL_SNAKE_POINTS
+            # check collisions between snakes, only live snakes are in the grid
+            for name2 in list(self._occupancy.owners(snake1.head)):
+                if name1 != name2:
+                    self.kill_snake(name1, "snake")
+                    self._snakes[name2].score += KILL_SNAKE_POINTS
 
             # check collisions with the map
             if self.map.is_blocked(snake1.head, traverse=snake1._traverse):
@@ -262,7 +507,7 @@ class Game:
                     name1,
                     snake1.head,
                 )
-                self.kill_snake(name1)
+                self.kill_snake(name1, "stone")
 
             # check collisions with the food
             if self.map.get_tile(snake1.head) in [Tiles.FOOD, Tiles.SUPER]:
@@ -273,7 +518,7 @@ class Game:
                     snake1.grow()
                     self.map.spawn_food()
                 elif what_i_ate == Tiles.SUPER:
-                    kind = random.choice(
+                    kind = self._rng.choice(
                         [
                             SuperFood.POINTS,
                             SuperFood.LENGTH,
@@ -284,15 +529,15 @@ class Game:
                     logger.debug("Snake <%s> ate <%s> at position (%s)", name1, kind.name, snake1.head)
 
                     if kind == SuperFood.POINTS:
-                        points = random.randint(-5, 10)
+                        points = self._rng.randint(-5, 10)
                         snake1.score += points 
                         logger.debug("Snake ate superfood and scored: %s", points)
                     elif kind == SuperFood.LENGTH:
-                        extra = random.randint(-2, 2)
+                        extra = self._rng.randint(-2, 2)
                         snake1.grow(extra)
                         logger.debug("Snake ate superfood and grew: %s", extra)
                     elif kind == SuperFood.RANGE:
-                        snake1.range += random.randint(-2, 2)
+                        snake1.range += self._rng.randint(-2, 2)
                         snake1.range = min(max(snake1.range, 2), 6) # range between 2 and 6
                         logger.debug("Snake ate superfood and range changed to: %s", snake1.range)
                     elif kind == SuperFood.TRAVERSE:
@@ -300,13 +545,28 @@ class Game:
                         logger.debug("Snake ate superfood and traverse is: %s", snake1._traverse)
 
     async def next_frame(self):
-        await asyncio.sleep(1.0 / self._game_speed)
+        await self.scheduler.wait()
+        return self.step()
+
+    def step(self, keys=None):
+        """Advance the game by one frame without waiting.
+
+        keys optionally maps player names to the key each one pressed since
+        the previous frame, as if they had been sent through keypress().
+        """
+        for name, key in (keys or {}).items():
+            if key is not None:
+                self.keypress(name, key)
 
         if not self._running:
             logger.info("Waiting for player 1")
             return
 
+        if self.recorder is not None:
+            self.recorder.record_step(self)
+
         self._step += 1
+        self._moved.clear()
         if self._step == self._timeout:
             self.stop()
 
@@ -316,13 +576,16 @@ class Game:
             for name, snake in self._snakes.items():
                 logger.debug(f"[{self._step}] SCORE {name}: {snake.score}")
 
+        start = perf_counter()
         for name, snake in self._snakes.items():
             if not snake.alive:
                 continue
             self.update_snake(name)
 
+        moved = perf_counter()
         self.collision()
 
+        collided = perf_counter()
         self._state = {
             "food": self.map.food,
             "players": [snake for snake in self._snakes],
@@ -332,7 +595,6 @@ class Game:
                 {
                     "name": name,
                     "body": snake.body[::-1],
-                    "sight": snake.sight(self.map, self._snakes.values()),
                     "score": snake.score,
                     "range": snake.range,
                     "traverse": snake._traverse,
@@ -342,16 +604,121 @@ class Game:
             ],
         }
 
+        if self.metrics is not None:
+            self.metrics.observe(moved - start, "update_snake")
+            self.metrics.observe(collided - moved, "collision")
+            self.metrics.observe(perf_counter() - collided, "state")
+
         if all([not snake.alive for snake in self._snakes.values()]):
             self.stop()
 
+        if self.recorder is not None:
+            self.recorder.record_frame(self)
+
         return self._state
 
+    def player_states(self, state, names=None):
+        """Split the last frame into the state sent to each player.
+
+        Players only get the common fields plus their own snake and its
+        sight, dead players get the common fields alone. Sight is left out of
+        frames, which viewers get, and only computed here for the players in
+        names (all of them by default).
+        """
+        if names is None:
+            names = self._snakes
+        common = {
+            key: value
+            for key, value in state.items()
+            if key not in ("snakes", "food")
+        }
+        own = {snake["name"]: snake for snake in state["snakes"]}
+        start = perf_counter()
+        states = {}
+        for name in names:
+            if name in own:
+                sight = self._snakes[name].sight(self.map)
+                states[name] = {**common, **own[name], "sight": sight}
+            else:
+                states[name] = dict(common)
+        if self.metrics is not None:
+            self.metrics.observe(perf_counter() - start, "sight")
+        return states
+
+    def snapshot(self):
+        """Mark the current state of the game, to go back to it with restore().
+
+        Only small values are copied, the map, occupancy grid and snake bodies
+        record how to undo their changes in a journal instead, so restoring
+        costs as much as the changes made since the snapshot. Snapshots are
+        valid until restoring an older one; call forget_snapshots() to stop
+        recording once the search is over.
+        """
+        if self._journal is None:
+            self._journal = []
+            self.map.set_journal(self._journal)
+            self._occupancy._journal = self._journal
+            self._rng.journal = self._journal
+            for snake in self._snakes.values():
+                snake._journal = self._journal
+        self._rng.saved = False
+        return (
+            len(self._journal),
+            self._step,
+            self._running,
+            self._state,
+            {name: snake.snapshot() for name, snake in self._snakes.items()},
+        )
+
+    def restore(self, snapshot):
+        """Go back to the state of a snapshot() of this game."""
+        mark, self._step, self._running, self._state, snakes = snapshot
+        rollback(self._journal, mark)
+        self._rng.saved = False
+        for name, snake_snapshot in snakes.items():
+            self._snakes[name].restore(snake_snapshot)
+
+    def forget_snapshots(self):
+        """Stop recording changes, previous snapshots can no longer be restored."""
+        self._journal = None
+        self.map.set_journal(None)
+        self._occupancy._journal = None
+        self._rng.journal = None
+        for snake in self._snakes.values():
+            snake._journal = None
+
     def info(self):
         return {
             "size": self.map.size,
-            "map": self.map.map,
+            "map": self.map.export(),
             "fps": self._game_speed,
             "timeout": self._timeout,
             "level": self.map.level,
         }
+
+
+def run_headless(agents, game=None, **kwargs):
+    """Play a full game as fast as possible, without a server or sleeps.
+
+    agents maps each player name to a callable that receives that player's
+    state and returns the key to press on the next frame. Extra keyword
+    arguments are passed to Game when no game is given. A given game may
+    already be started, e.g. to build the agents from its info().
+    """
+    if game is None:
+        game = Game(**kwargs)
+    if not game.snakes:
+        game.start(list(agents))
+
+    keys = {}
+    while game.running:
+        state = game.step(keys)
+        if state is None:
+            break
+        keys = {
+            name: agents[name](player_state)
+            for name, player_state in game.player_states(state).items()
+            if game.snakes[name].alive
+        }
+
+    return game
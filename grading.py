@@ -0,0 +1,171 @@
+"""Upload game records to the grading server without blocking the game loop.
+
+Records are appended to a JSONL queue file before anything is sent, so they
+survive a grading server outage and a restart of the game server. A single
+task posts them in batches over one HTTP session and retries failed ones
+with exponential backoff. The queue file is written on a single thread, off
+the event loop, in the order the writes were asked for. Records are only removed from the file once
+posted, so one may be posted twice if the server stops mid-upload.
+
+Run `python grading.py --stub` for a local grading server to test against.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger("Grading")
+logger.setLevel(logging.INFO)
+
+QUEUE_FILE = "grading_queue.jsonl"
+BATCH_SIZE = 20  # records posted concurrently
+REQUEST_TIMEOUT = 2  # seconds
+MIN_BACKOFF = 1  # seconds
+MAX_BACKOFF = 60
+
+
+class GradingUploader:
+    """Queue of game records posted to url by a background task."""
+
+    def __init__(self, url, queue_file=QUEUE_FILE, batch_size=BATCH_SIZE):
+        self.url = url
+        self.queue_file = queue_file
+        self.batch_size = batch_size
+        self.uploaded = 0
+        self._records = []
+        self._pending = asyncio.Event()
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1)  # keeps writes in order
+
+        if os.path.isfile(queue_file):
+            with open(queue_file) as infile:
+                self._records = [json.loads(line) for line in infile if line.strip()]
+            if self._records:
+                logger.info("%s records left to upload", len(self._records))
+                self._pending.set()
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def stop(self):
+        """Stop uploading, queued records stay on disk for the next start."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # wait for the queue file writes already asked for
+        await asyncio.get_running_loop().run_in_executor(self._executor, lambda: None)
+
+    def submit(self, record):
+        """Queue a record for upload, returns at once."""
+        self._records.append(record)
+        self._executor.submit(self._append, json.dumps(record) + "\n")
+        self._pending.set()
+
+    def __len__(self):
+        return len(self._records)
+
+    def _append(self, line):
+        try:
+            with open(self.queue_file, "a") as outfile:
+                outfile.write(line)
+        except OSError as err:
+            logger.error("Could not queue record: %s", err)
+
+    def _save(self, records):
+        """Rewrite the queue file with the records not uploaded yet."""
+        tmp = self.queue_file + ".tmp"
+        try:
+            with open(tmp, "w") as outfile:
+                outfile.writelines(json.dumps(record) + "\n" for record in records)
+            os.replace(tmp, self.queue_file)
+        except OSError as err:
+            logger.error("Could not save the upload queue: %s", err)
+
+    async def _post(self, session, record):
+        async with session.post(self.url, json=record) as response:
+            response.raise_for_status()
+
+    async def _run(self):
+        backoff = MIN_BACKOFF
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                await self._pending.wait()
+                batch = self._records[: self.batch_size]
+                results = await asyncio.gather(
+                    *(self._post(session, record) for record in batch),
+                    return_exceptions=True,
+                )
+                sent = [
+                    record
+                    for record, result in zip(batch, results)
+                    if not isinstance(result, Exception)
+                ]
+                for record in sent:
+                    self._records.remove(record)
+                self.uploaded += len(sent)
+                if sent:
+                    await asyncio.get_running_loop().run_in_executor(
+                        self._executor, self._save, list(self._records)
+                    )
+                if not self._records:
+                    self._pending.clear()
+
+                if len(sent) < len(batch):
+                    error = next(r for r in results if isinstance(r, Exception))
+                    logger.warning(
+                        "Could not upload %s records (%s), retrying in %.1fs",
+                        len(batch) - len(sent),
+                        error,
+                        backoff,
+                    )
+                    await asyncio.sleep(backoff * random.uniform(0.5, 1))
+                    # back off further only while nothing gets through
+                    backoff = MIN_BACKOFF if sent else min(backoff * 2, MAX_BACKOFF)
+                else:
+                    backoff = MIN_BACKOFF
+
+
+def stub_app(fail_rate=0.0):
+    """Grading server that logs the records it gets, failing some on purpose."""
+    records = []
+
+    async def game(request):
+        if random.random() < fail_rate:
+            raise web.HTTPServiceUnavailable()
+        record = await request.json()
+        records.append(record)
+        logger.info("Record %s: %s", len(records), record)
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_post("/game", game)
+    app["records"] = records
+    return app
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stub", help="Run a local grading server", action="store_true")
+    parser.add_argument("--port", help="TCP port of the stub", type=int, default=8001)
+    parser.add_argument(
+        "--fail-rate", help="Fraction of requests the stub fails", type=float, default=0
+    )
+    args = parser.parse_args()
+
+    if not args.stub:
+        parser.error("nothing to do, use --stub")
+    web.run_app(stub_app(args.fail_rate), port=args.port)
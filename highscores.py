@@ -0,0 +1,162 @@
+"""Highscores kept in SQLite, with the best ones in memory.
+
+Every score is appended to a SQLite database in WAL mode, so several server
+processes can write to it at once. All database work runs on a single
+thread, off the event loop. The top MAX_HIGHSCORES are kept in a heap that
+top() brings up to date with the scores saved since, by any process.
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger("Highscores")
+logger.setLevel(logging.INFO)
+
+HIGHSCORE_DB = "highscores.db"
+HIGHSCORE_FILE = "highscores.json"  # previous format, imported once
+MAX_HIGHSCORES = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    id INTEGER PRIMARY KEY,
+    player TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    players INTEGER,
+    ts TEXT
+);
+CREATE INDEX IF NOT EXISTS scores_player ON scores (player, score);
+CREATE INDEX IF NOT EXISTS scores_players ON scores (players, score);
+"""
+
+
+class HighscoreStore:
+    """Append-only store of game scores."""
+
+    def __init__(self, path=HIGHSCORE_DB, size=MAX_HIGHSCORES, legacy=HIGHSCORE_FILE):
+        self.size = size
+        self._executor = ThreadPoolExecutor(max_workers=1)  # sqlite wants one thread
+        self._db = None
+        self._top = []  # min heap of (score, -id, player), the best `size` scores
+        self._last_id = 0  # newest score in the heap, only used on the db thread
+        self._executor.submit(self._open, path, legacy).result()
+
+    def _open(self, path, legacy):
+        self._db = sqlite3.connect(path, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+        (count,) = self._db.execute("SELECT COUNT(*) FROM scores").fetchone()
+        if not count and legacy and os.path.isfile(legacy):
+            with open(legacy) as infile:
+                scores = json.load(infile)
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO scores (player, score) VALUES (?, ?)", scores
+                )
+            logger.info("Imported %s highscores from %s", len(scores), legacy)
+
+        (self._last_id,) = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM scores").fetchone()
+        rows = self._db.execute(
+            "SELECT id, player, score FROM scores ORDER BY score DESC, id LIMIT ?",
+            (self.size,),
+        )
+        self._top = [(score, -id_, player) for id_, player, score in rows]
+        heapq.heapify(self._top)
+
+    def add(self, player, score, players=None):
+        """Record a score, the database is written in the background."""
+        return self._executor.submit(
+            self._insert, player, score, players, datetime.now().isoformat()
+        )
+
+    def _insert(self, player, score, players, ts):
+        try:
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO scores (player, score, players, ts) VALUES (?, ?, ?, ?)",
+                    (player, score, players, ts),
+                )
+        except sqlite3.Error as err:
+            logger.error("Could not save score of <%s>: %s", player, err)
+
+    def _refresh(self):
+        """Add the scores saved since the last refresh to the heap."""
+        rows = self._db.execute(
+            "SELECT id, player, score FROM scores WHERE id > ? ORDER BY id",
+            (self._last_id,),
+        )
+        for id_, player, score in rows:
+            self._last_id = id_
+            entry = (score, -id_, player)
+            if len(self._top) < self.size:
+                heapq.heappush(self._top, entry)
+            elif entry > self._top[0]:  # ties keep the older score
+                heapq.heapreplace(self._top, entry)
+        return [(player, score) for score, _, player in sorted(self._top, reverse=True)]
+
+    async def top(self):
+        """Best scores as (player, score), best first."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._refresh)
+
+    def _query(self, sql, args):
+        return [tuple(row) for row in self._db.execute(sql, args)]
+
+    async def _run(self, sql, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._query, sql, args)
+
+    async def player_scores(self, player, limit=MAX_HIGHSCORES):
+        """Best scores of a player as (score, players, ts)."""
+        return await self._run(
+            "SELECT score, players, ts FROM scores WHERE player = ? "
+            "ORDER BY score DESC, id LIMIT ?",
+            player,
+            limit,
+        )
+
+    async def top_for_players(self, players, limit=MAX_HIGHSCORES):
+        """Best scores of games with that many players as (player, score)."""
+        return await self._run(
+            "SELECT player, score FROM scores WHERE players = ? "
+            "ORDER BY score DESC, id LIMIT ?",
+            players,
+            limit,
+        )
+
+    def close(self):
+        """Wait for pending writes and close the database."""
+        self._executor.submit(self._db.close)
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="Highscore database", default=HIGHSCORE_DB)
+    parser.add_argument("--player", help="Show the best scores of a player")
+    parser.add_argument("--players", help="Only games with that many players", type=int)
+    parser.add_argument("--limit", help="Scores to show", type=int, default=MAX_HIGHSCORES)
+    args = parser.parse_args()
+
+    async def main():
+        store = HighscoreStore(args.db, args.limit)
+        if args.player:
+            rows = await store.player_scores(args.player, args.limit)
+        elif args.players:
+            rows = await store.top_for_players(args.players, args.limit)
+        else:
+            rows = await store.top()
+        store.close()
+        for row in rows:
+            print(*row, sep="\t")
+
+    asyncio.run(main())
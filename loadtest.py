@@ -0,0 +1,201 @@
+"""Load test a running server.py with synthetic players and viewers.
+
+Players join /player (or /player/<room>), answer every frame with a key after
+a think time and join again when their game is over. Viewers watch /viewer.
+At the end it reports:
+    jitter   how far the interval between the ts of consecutive frames is
+             from the tick period announced in the game info
+    latency  time from the ts stamped by the server to the frame arriving
+    skipped  steps a player never got a frame of (superseded in its outbox)
+    dropped  connections refused or closed abnormally, game over is a
+             normal close
+
+Run it on the machine of the server, latency compares both clocks.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import time
+from datetime import datetime
+
+import websockets
+
+import protocol
+
+logger = logging.getLogger("LoadTest")
+logger.setLevel(logging.INFO)
+
+KEYS = "wasd"
+CONNECT_RATE = 50  # new connections per second while ramping up
+PERCENTILES = (50, 90, 99)
+
+
+class LoadStats:
+    """Measurements of every synthetic client."""
+
+    def __init__(self):
+        self.jitter = []  # seconds
+        self.latency = []  # seconds
+        self.frames = 0
+        self.skipped = 0
+        self.games = 0
+        self.connections = 0
+        self.dropped = 0
+
+    def frame(self, state, last, period):
+        """Record a player frame, last is the previous one of that game."""
+        self.frames += 1
+        ts = datetime.fromisoformat(state["ts"]).timestamp()
+        self.latency.append(time.time() - ts)
+        if last is not None:
+            steps = state["step"] - last["step"]
+            self.skipped += max(steps - 1, 0)
+            interval = ts - datetime.fromisoformat(last["ts"]).timestamp()
+            self.jitter.append(abs(interval - steps * period))
+
+    def report(self):
+        report = {
+            "connections": self.connections,
+            "dropped": self.dropped,
+            "games": self.games,
+            "frames": self.frames,
+            "skipped": self.skipped,
+        }
+        for name in ("jitter", "latency"):
+            if values := getattr(self, name):
+                report[name] = {k: round(v * 1000, 1) for k, v in summarize(values).items()}
+        return report
+
+
+def summarize(values):
+    """Mean, percentiles and max of a list of numbers."""
+    values = sorted(values)
+    summary = {"mean": statistics.fmean(values)}
+    for p in PERCENTILES:
+        summary[f"p{p}"] = values[min(len(values) - 1, len(values) * p // 100)]
+    summary["max"] = values[-1]
+    return summary
+
+
+async def player(
+    server, name, stats, deadline, room=None, think=0, keys=None, encoding=protocol.JSON
+):
+    """Play games until the deadline, keys are random unless scripted."""
+    path = f"/player/{room}" if room else "/player"
+    script = 0
+    while time.monotonic() < deadline:
+        stats.connections += 1
+        try:
+            async with websockets.connect(f"ws://{server}{path}", max_size=None) as ws:
+                await ws.send(json.dumps({"cmd": "join", "name": name, "encoding": encoding}))
+                period, last = None, None
+                async for message in ws:
+                    state = protocol.loads(message)
+                    if "fps" in state:  # game info
+                        period, last = 1 / state["fps"], None
+                        stats.games += 1
+                        continue
+                    if "highscores" in state:
+                        continue
+                    stats.frame(state, last, period)
+                    last = state
+                    if think:
+                        await asyncio.sleep(think)
+                    if keys:
+                        key, script = keys[script % len(keys)], script + 1
+                    else:
+                        key = random.choice(KEYS)
+                    await ws.send(
+                        json.dumps({"cmd": "key", "key": key, "step": state["step"]})
+                    )
+        except websockets.exceptions.ConnectionClosedOK:
+            pass  # game over
+        except (OSError, websockets.exceptions.WebSocketException) as err:
+            if time.monotonic() < deadline:
+                stats.dropped += 1
+                logger.warning("<%s> dropped: %s", name, err)
+                await asyncio.sleep(1)
+
+
+async def viewer(server, stats, deadline, room=None, encoding=protocol.JSON):
+    """Watch until the deadline, viewers are not sent ts."""
+    path = f"/viewer/{room}" if room else "/viewer"
+    while time.monotonic() < deadline:
+        stats.connections += 1
+        try:
+            async with websockets.connect(f"ws://{server}{path}", max_size=None) as ws:
+                await ws.send(json.dumps({"cmd": "join", "encoding": encoding}))
+                async for _ in ws:
+                    if time.monotonic() > deadline:
+                        return
+        except websockets.exceptions.ConnectionClosedOK:
+            pass
+        except (OSError, websockets.exceptions.WebSocketException) as err:
+            if time.monotonic() < deadline:
+                stats.dropped += 1
+                logger.warning("Viewer dropped: %s", err)
+        await asyncio.sleep(1)  # server closed the room, wait for the next one
+
+
+async def run(
+    server, players, viewers, duration, room=None, think=0, keys=None, encoding=protocol.JSON
+):
+    """Drive the server with synthetic clients for duration seconds."""
+    stats = LoadStats()
+    deadline = time.monotonic() + duration
+    clients = []
+    for i in range(players + viewers):
+        if i < players:
+            client = player(server, f"load{i}", stats, deadline, room, think, keys, encoding)
+        else:
+            client = viewer(server, stats, deadline, room, encoding)
+        clients.append(asyncio.ensure_future(client))
+        await asyncio.sleep(1 / CONNECT_RATE)
+
+    await asyncio.sleep(max(deadline - time.monotonic(), 0))
+    for client in clients:
+        client.cancel()
+    await asyncio.gather(*clients, return_exceptions=True)
+    return stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", help="Server address", default="localhost:8000")
+    parser.add_argument("--players", help="Synthetic players", type=int, default=10)
+    parser.add_argument("--viewers", help="Synthetic viewers", type=int, default=0)
+    parser.add_argument("--duration", help="Seconds to run", type=float, default=30)
+    parser.add_argument("--room", help="Play and watch this room, not matchmaking")
+    parser.add_argument(
+        "--think", help="Seconds a player takes to answer a frame", type=float, default=0
+    )
+    parser.add_argument("--keys", help="Keys to send in a loop, e.g. wwdd (random if unset)")
+    parser.add_argument("--encoding", choices=protocol.ENCODINGS, default=protocol.JSON)
+    parser.add_argument(
+        "--max-jitter", help="Fail if the p90 jitter is above this many ms", type=float
+    )
+    args = parser.parse_args()
+
+    stats = asyncio.run(
+        run(
+            args.server,
+            args.players,
+            args.viewers,
+            args.duration,
+            args.room,
+            args.think,
+            args.keys,
+            args.encoding,
+        )
+    )
+    report = stats.report()
+    print(json.dumps(report, indent=2))
+    if args.max_jitter is not None and report.get("jitter", {}).get("p90", 0) > args.max_jitter:
+        logger.error("Tick jitter p90 above %s ms", args.max_jitter)
+        raise SystemExit(1)
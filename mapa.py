@@ -1,83 +1,252 @@
 import logging
 import random
 import math
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for the optional numpy grid
+    np = None
 
 from consts import Direction, Tiles, VITAL_SPACE, NEST_SIZE
 
 logger = logging.getLogger("Map")
 logger.setLevel(logging.DEBUG)
 
+WALKABLE = frozenset((Tiles.PASSAGE, Tiles.FOOD, Tiles.SUPER))
+
+
+@lru_cache(maxsize=None)
+def disk_offsets(size):
+    """Offsets (dx, dy) within euclidean distance size, in get_zone order."""
+    return tuple(
+        (dx, dy)
+        for dx in range(-size, size + 1)
+        for dy in range(-size, size + 1)
+        if math.dist((0, 0), (dx, dy)) <= size
+    )
+
+
+@lru_cache(maxsize=None)
+def disk_offset_arrays(size):
+    """disk_offsets(size) as a pair of numpy arrays (dx, dy)."""
+    dx, dy = zip(*disk_offsets(size))
+    return np.array(dx), np.array(dy)
+
+
+def rollback(journal, mark):
+    """Undo the changes recorded in a journal after mark, newest first."""
+    while len(journal) > mark:
+        undo, *args = journal.pop()
+        undo(*args)
+
+
+class FreeCells:
+    """Set of cells with O(1) insert, delete and uniform random sampling."""
+
+    def __init__(self, cells=()):
+        self._cells = []
+        self._index = {}  # cell -> position in _cells
+        self._journal = None  # undo log, see Map.snapshot
+        for cell in cells:
+            self.add(cell)
+
+    def add(self, cell):
+        if cell not in self._index:
+            self._index[cell] = len(self._cells)
+            self._cells.append(cell)
+            if self._journal is not None:
+                self._journal.append((self._undo_add,))
+
+    def _undo_add(self):
+        del self._index[self._cells.pop()]
+
+    def discard(self, cell):
+        i = self._index.pop(cell, None)
+        if i is None:
+            return
+        last = self._cells.pop()
+        if i < len(self._cells):  # move the last cell into the hole
+            self._cells[i] = last
+            self._index[last] = i
+        if self._journal is not None:
+            self._journal.append((self._undo_discard, cell, i))
+
+    def _undo_discard(self, cell, i):
+        if i < len(self._cells):  # move the cell that filled the hole back
+            last = self._cells[i]
+            self._index[last] = len(self._cells)
+            self._cells.append(last)
+            self._cells[i] = cell
+        else:
+            self._cells.append(cell)
+        self._index[cell] = i
+
+    def sample(self, rng):
+        return self._cells[rng.randrange(len(self._cells))]
+
+    def __contains__(self, cell):
+        return cell in self._index
+
+    def __len__(self):
+        return len(self._cells)
+
+
 class Map:
     def __init__(
         self,
         level=1,
         size=(VITAL_SPACE + 10, VITAL_SPACE + 10),
         mapa=None,
+        rng=None,
+        numpy_grid=False,
     ):
         assert size[0] > VITAL_SPACE + 9
         assert size[1] > VITAL_SPACE + 9
+        if numpy_grid and np is None:
+            raise ImportError("numpy is required for numpy_grid")
 
         self._level = level
         self._size = size
         self._stones = []
         self._food = []
-        self._snake_nests = []
+        self._snake_nests = set()
+        self._occupied = set()  # cells taken by snakes
+        self._journal = None  # undo log, see snapshot()
+        self._rng = rng or random.Random()
+        self._numpy_grid = numpy_grid
 
         if not mapa:
             logger.info("Generating a MAP")
-            self.map = [[Tiles.PASSAGE] * self.ver_tiles for _ in range(self.hor_tiles)]
+            if numpy_grid:
+                self.map = np.full(size, Tiles.PASSAGE, dtype=np.uint8)
+            else:
+                self.map = [[Tiles.PASSAGE] * self.ver_tiles for _ in range(self.hor_tiles)]
 
             # add stones
             for _ in range(10):
-                x, y = random.randint(0, self.hor_tiles - 1), random.randint(
+                x, y = self._rng.randint(0, self.hor_tiles - 1), self._rng.randint(
                     0, self.ver_tiles - 1
                 )
                 wall_length = 5
                 for yy in range(
-                    y, (y + random.choice([-wall_length, wall_length])) % self.ver_tiles
+                    y, (y + self._rng.choice([-wall_length, wall_length])) % self.ver_tiles
                 )[:wall_length]:
                     self.map[x][yy] = Tiles.STONE
                     self._stones.append((x, yy))
                 for xx in range(
-                    x, (x + random.choice([-wall_length, wall_length])) % self.hor_tiles
+                    x, (x + self._rng.choice([-wall_length, wall_length])) % self.hor_tiles
                 )[:wall_length]:
                     self.map[xx][y] = Tiles.STONE
                     self._stones.append((xx, y))
 
         else:
             logger.info("Loading MAP")
-            self.map = mapa
+            self.map = np.array(mapa, dtype=np.uint8) if numpy_grid else mapa
+
+        # cells where food can spawn, and the subset where snakes can spawn
+        if numpy_grid:
+            passages = map(tuple, np.argwhere(self.map == Tiles.PASSAGE).tolist())
+        else:
+            passages = (
+                (x, y)
+                for x in range(self.hor_tiles)
+                for y in range(self.ver_tiles)
+                if self.map[x][y] == Tiles.PASSAGE
+            )
+        self._free = FreeCells(passages)
+        self._spawnable = FreeCells(self._free._cells)
 
     @property
     def food(self):
-        return [(x, y, self.map[x][y].name) for x, y in self._food]
+        return [(x, y, self.get_tile((x, y)).name) for x, y in self._food]
 
     def spawn_snake(self):
-        x = random.randint(0, self.hor_tiles - 1)
-        y = random.randint(0, self.ver_tiles - 1)
-        while any((x, y) in nest for nest in self._snake_nests):
-            x = random.randint(0, self.hor_tiles - 1)
-            y = random.randint(0, self.ver_tiles - 1)
-        self._snake_nests.append([(a, b) for a in range(x - NEST_SIZE, x + NEST_SIZE) for b in range(y - NEST_SIZE, y + NEST_SIZE)])
+        cells = self._spawnable if self._spawnable else self._free
+        if not cells:
+            raise RuntimeError("No free cell left to spawn a snake")
+        x, y = cells.sample(self._rng)
+        for a in range(x - NEST_SIZE, x + NEST_SIZE):
+            for b in range(y - NEST_SIZE, y + NEST_SIZE):
+                nest = (a % self.hor_tiles, b % self.ver_tiles)
+                if nest not in self._snake_nests:
+                    self._snake_nests.add(nest)
+                    self._record(self._snake_nests.discard, nest)
+                self._spawnable.discard(nest)
         return x, y
 
     def spawn_food(self, food_type=Tiles.FOOD):
-        x = random.randint(0, self.hor_tiles - 1)
-        y = random.randint(0, self.ver_tiles - 1)
-        while (x, y) in self._food or (x, y) in self._stones:
-            x = random.randint(0, self.hor_tiles - 1)
-            y = random.randint(0, self.ver_tiles - 1)
-        self.map[x][y] = food_type
+        if not self._free:
+            logger.warning("No free cell left to spawn food")
+            return
+        x, y = self._free.sample(self._rng)
+        self._free.discard((x, y))
+        self._spawnable.discard((x, y))
+        self._set_tile(x, y, food_type)
         self._food.append((x, y))
+        self._record(self._food.pop)
         logger.debug("Food spawned at %s", self._food[-1])
 
     def eat_food(self, pos):
         x, y = pos
-        old = self.map[x][y]
-        self.map[x][y] = Tiles.PASSAGE
-        self._food.remove((x, y))
+        old = self.get_tile(pos)
+        self._set_tile(x, y, Tiles.PASSAGE)
+        i = self._food.index((x, y))
+        del self._food[i]
+        self._record(self._food.insert, i, (x, y))
+        if pos not in self._occupied:
+            self._release_cell(pos)
         return old
 
+    def occupy(self, pos):
+        """Mark a cell as taken by a snake."""
+        if pos not in self._occupied:
+            self._occupied.add(pos)
+            self._record(self._occupied.discard, pos)
+        self._free.discard(pos)
+        self._spawnable.discard(pos)
+
+    def release(self, pos):
+        """Mark a cell as no longer taken by any snake."""
+        if pos in self._occupied:
+            self._occupied.discard(pos)
+            self._record(self._occupied.add, pos)
+        x, y = pos
+        if self.get_tile(pos) == Tiles.PASSAGE:
+            self._release_cell(pos)
+
+    def _set_tile(self, x, y, tile):
+        self._record(self._set_tile_unrecorded, x, y, self.map[x][y])
+        self._set_tile_unrecorded(x, y, tile)
+
+    def _set_tile_unrecorded(self, x, y, tile):
+        self.map[x][y] = tile
+
+    def _record(self, undo, *args):
+        if self._journal is not None:
+            self._journal.append((undo, *args))
+
+    def set_journal(self, journal):
+        """Record how to undo every change in journal (a list), None to stop."""
+        self._journal = journal
+        self._free._journal = journal
+        self._spawnable._journal = journal
+
+    def snapshot(self):
+        """Mark the current state, to go back to it with restore()."""
+        if self._journal is None:
+            self.set_journal([])
+        return len(self._journal)
+
+    def restore(self, mark):
+        """Undo every change made since snapshot() returned mark."""
+        rollback(self._journal, mark)
+
+    def _release_cell(self, pos):
+        self._free.add(pos)
+        if pos not in self._snake_nests:
+            self._spawnable.add(pos)
+
     @property
     def hor_tiles(self):
         return self.size[0]
@@ -104,21 +273,37 @@ class Map:
     def digdug_spawn(self):
         return self._digdug_spawn
 
+    def export(self):
+        """Tiles as a list of columns, ready to be serialized."""
+        if self._numpy_grid:
+            return self.map.tolist()
+        return self.map
+
     def get_tile(self, pos: tuple[int, int]):
         x, y = pos
+        if self._numpy_grid:
+            return Tiles(self.map.item(x, y))
         return self.map[x][y]
 
     def get_zone(self, pos: tuple[int, int], size: int):
         zone: dict[int, dict[int, Tiles]] = {}
         x, y = pos
-        for i in range(x - size, x + size + 1):
-            for j in range(y - size, y + size + 1):
-                if math.dist((x, y), (i, j)) <= size:
-                    ii = i % self.hor_tiles
-                    jj = j % self.ver_tiles
-                    if ii not in zone:
-                        zone[ii] = {}
-                    zone[ii][jj] = self.map[ii][jj]
+        if self._numpy_grid:
+            dx, dy = disk_offset_arrays(size)
+            xs = (x + dx) % self.hor_tiles
+            ys = (y + dy) % self.ver_tiles
+            for ii, jj, tile in zip(xs.tolist(), ys.tolist(), self.map[xs, ys].tolist()):
+                if ii not in zone:
+                    zone[ii] = {}
+                zone[ii][jj] = tile
+            return zone
+
+        for dx, dy in disk_offsets(size):
+            ii = (x + dx) % self.hor_tiles
+            jj = (y + dy) % self.ver_tiles
+            if ii not in zone:
+                zone[ii] = {}
+            zone[ii][jj] = self.map[ii][jj]
 
         return zone
 
@@ -129,15 +314,14 @@ class Map:
         ):
             logger.debug("Crash against map edge(%s, %s)", x, y)
             return True
-        if self.map[x][y] == Tiles.PASSAGE:
-            return False
-        if self.map[x][y] == Tiles.STONE:
+        tile = self.map.item(x, y) if self._numpy_grid else self.map[x][y]
+        if tile == Tiles.STONE:
             if traverse:
                 return False
             else:
                 logger.debug("Crash against Stone(%s, %s)", x, y)
                 return True
-        if self.map[x][y] in [Tiles.FOOD, Tiles.SUPER]:
+        if tile in WALKABLE:
             return False
 
         assert False, "Unknown tile type"
@@ -0,0 +1,126 @@
+"""Histograms, gauges and counters exposed in the Prometheus text format.
+
+Metrics register themselves in REGISTRY when created, replacing an older
+one of the same name. serve() starts an aiohttp server answering
+GET /metrics with all of them.
+"""
+import logging
+from bisect import bisect_left
+
+from aiohttp import web
+
+logger = logging.getLogger("Metrics")
+logger.setLevel(logging.INFO)
+
+# seconds, from a fraction of a game step to a whole tick and beyond
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+)
+
+REGISTRY = {}  # name -> metric
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY[name] = self
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. durations in seconds."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for values, series in self._series.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                labels = _labels(self.labels, values, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {total}"
+            labels = _labels(self.labels, values)
+            yield f"{self.name}_sum{labels} {series[-1]!r}"
+            yield f"{self.name}_count{labels} {total}"
+
+
+class Counter(Metric):
+    """Value that only goes up."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for values, value in self._values.items():
+            yield f"{self.name}{_labels(self.labels, values)} {_number(value)}"
+
+
+class Gauge(Metric):
+    """Value read when scraped from a function returning it."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        super().__init__(name, help)
+        self.read = read
+
+    def samples(self):
+        yield f"{self.name} {_number(self.read())}"
+
+
+def render(registry=REGISTRY):
+    """All metrics in the Prometheus text format."""
+    return "\n".join(metric.render() for metric in registry.values()) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def serve(port, host="127.0.0.1"):
+    """Answer GET /metrics on host:port, return the aiohttp runner."""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics @ http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,288 @@
+"""Compact binary encoding of the frames sent every tick.
+
+Clients ask for it with "encoding": "binary" in their join message, JSON
+stays the default. Only the per tick frames are binary: game info and
+highscores are rare and stay JSON text messages, so clients tell them
+apart by the websocket message type (see loads()).
+
+Layout (little endian):
+    header  tag:c step:I timeout:I width:H height:H ts:d players:B
+            players x (len:B name:utf8)
+    player  header(b"P") own:B [snake sight]  own is NO_SNAKE for dead players
+    viewer  header(b"V") food:H food x (x:H y:H super:B)
+            snakes:B snakes x (player index:B snake)
+    snake   score:i range:B traverse:B length:H length x (x:H y:H)
+    sight   one 4 bit tile per cell of disk_offsets(range) around the head
+
+Decoding gives the same dicts as JSON, except sight is keyed by int.
+Player names must fit MAX_NAME_BYTES, frames that do not fit the layout
+raise ValueError or struct.error.
+
+Viewers that join with "deltas": true get, between full frames, JSON text
+frames {"step": n, "delta": {...}} built by state_delta() that only hold
+what changed since the previous frame; apply_delta() rebuilds the frame.
+"""
+import json
+import struct
+from datetime import datetime
+
+from consts import Tiles
+from mapa import disk_offsets
+
+JSON = "json"
+BINARY = "binary"
+ENCODINGS = (JSON, BINARY)
+
+PLAYER_TAG = b"P"
+VIEWER_TAG = b"V"
+NO_SNAKE = 0xFF
+MAX_NAME_BYTES = 0xFF  # of a player name in utf8
+
+HEADER = struct.Struct("<cIIHHdB")
+SNAKE = struct.Struct("<iBBH")
+CELL = struct.Struct("<HH")
+FOOD = struct.Struct("<HHB")
+COUNT = struct.Struct("<H")
+
+
+def _pack_header(tag, state, size, out):
+    ts = state.get("ts")
+    out.append(
+        HEADER.pack(
+            tag,
+            state["step"],
+            state["timeout"],
+            *size,
+            datetime.fromisoformat(ts).timestamp() if ts else 0.0,
+            len(state["players"]),
+        )
+    )
+    for name in state["players"]:
+        name = name.encode()
+        out.append(bytes([len(name)]) + name)
+
+
+def _pack_snake(snake, out):
+    body = snake["body"]
+    out.append(SNAKE.pack(snake["score"], snake["range"], snake["traverse"], len(body)))
+    out.extend(CELL.pack(*cell) for cell in body)
+
+
+def _pack_sight(snake, size, out):
+    width, height = size
+    hx, hy = snake["body"][0]
+    sight = snake["sight"]
+    tiles = [
+        sight[(hx + dx) % width][(hy + dy) % height]
+        for dx, dy in disk_offsets(snake["range"])
+    ]
+    if len(tiles) % 2:
+        tiles.append(0)
+    out.append(bytes(tiles[i] | tiles[i + 1] << 4 for i in range(0, len(tiles), 2)))
+
+
+def encode_player_state(state, size):
+    """Binary frame of a state from Game.player_states(), map of size (w, h)."""
+    out = []
+    _pack_header(PLAYER_TAG, state, size, out)
+    if "body" in state:
+        out.append(bytes([state["players"].index(state["name"])]))
+        _pack_snake(state, out)
+        _pack_sight(state, size, out)
+    else:
+        out.append(bytes([NO_SNAKE]))
+    return b"".join(out)
+
+
+def encode_state(state, size):
+    """Binary frame of a full game state for viewers, map of size (w, h)."""
+    out = []
+    _pack_header(VIEWER_TAG, state, size, out)
+    food = state["food"]
+    out.append(COUNT.pack(len(food)))
+    out.extend(FOOD.pack(x, y, kind == Tiles.SUPER.name) for x, y, kind in food)
+
+    players = state["players"]
+    out.append(bytes([len(state["snakes"])]))
+    for snake in state["snakes"]:
+        out.append(bytes([players.index(snake["name"])]))
+        _pack_snake(snake, out)
+    return b"".join(out)
+
+
+def encode(state, size):
+    """Binary frame of a player or viewer state."""
+    if "snakes" in state:
+        return encode_state(state, size)
+    return encode_player_state(state, size)
+
+
+def _unpack_snake(name, data, offset):
+    score, sight_range, traverse, length = SNAKE.unpack_from(data, offset)
+    offset += SNAKE.size
+    end = offset + length * CELL.size
+    body = [list(cell) for cell in CELL.iter_unpack(data[offset:end])]
+
+    snake = {
+        "name": name,
+        "body": body,
+        "score": score,
+        "range": sight_range,
+        "traverse": bool(traverse),
+    }
+    return snake, end
+
+
+def _unpack_sight(snake, data, offset, size):
+    width, height = size
+    hx, hy = snake["body"][0]
+    offsets = disk_offsets(snake["range"])
+    packed = data[offset : offset + (len(offsets) + 1) // 2]
+    offset += len(packed)
+    tiles = [tile for pair in packed for tile in (pair & 0xF, pair >> 4)]
+    sight = {}
+    for (dx, dy), tile in zip(offsets, tiles):
+        x = (hx + dx) % width
+        if x not in sight:
+            sight[x] = {}
+        sight[x][(hy + dy) % height] = tile
+    return sight, offset
+
+
+def decode(data):
+    """Decode a binary frame into the dict its JSON version would give."""
+    tag, step, timeout, width, height, ts, count = HEADER.unpack_from(data)
+    offset = HEADER.size
+    players = []
+    for _ in range(count):
+        length = data[offset]
+        players.append(data[offset + 1 : offset + 1 + length].decode())
+        offset += 1 + length
+    size = width, height
+
+    state = {}
+    if tag == VIEWER_TAG:
+        (food_count,) = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        food = []
+        for _ in range(food_count):
+            x, y, is_super = FOOD.unpack_from(data, offset)
+            food.append([x, y, Tiles.SUPER.name if is_super else Tiles.FOOD.name])
+            offset += FOOD.size
+        state["food"] = food
+    state.update(players=players, step=step, timeout=timeout)
+
+    if tag == VIEWER_TAG:
+        snakes = []
+        count = data[offset]
+        offset += 1
+        for _ in range(count):
+            snake, offset = _unpack_snake(players[data[offset]], data, offset + 1)
+            snakes.append(snake)
+        state["snakes"] = snakes
+    elif data[offset] != NO_SNAKE:
+        snake, offset = _unpack_snake(players[data[offset]], data, offset + 1)
+        snake["sight"], offset = _unpack_sight(snake, data, offset, size)
+        state.update(snake)
+    if ts:
+        state["ts"] = datetime.fromtimestamp(ts).isoformat()
+    return state
+
+
+def _body_delta(previous, body):
+    """Cells added at the head and count removed at the tail, None if unrelated."""
+    if previous:
+        old_head = tuple(previous[0])
+        for added, cell in enumerate(body):
+            if tuple(cell) == old_head:
+                removed = len(previous) - (len(body) - added)
+                if removed >= 0:
+                    return {"head": [list(c) for c in body[:added]], "tail": removed}
+                break
+    return None
+
+
+def state_delta(previous, state):
+    """What changed between two consecutive viewer frames of a game."""
+    delta = {}
+
+    snakes = {}
+    before = {snake["name"]: snake for snake in previous["snakes"]}
+    for snake in state["snakes"]:
+        old = before.get(snake["name"])
+        changes = _body_delta(old["body"], snake["body"]) if old else None
+        if changes is None:
+            changes = {"body": [list(cell) for cell in snake["body"]]}
+        elif not changes["head"] and not changes["tail"]:
+            del changes["head"], changes["tail"]
+        for key in ("score", "range", "traverse"):
+            if old is None or old[key] != snake[key]:
+                changes[key] = snake[key]
+        if changes:
+            snakes[snake["name"]] = changes
+    if snakes:
+        delta["snakes"] = snakes
+    alive = {snake["name"] for snake in state["snakes"]}
+    if dead := [name for name in before if name not in alive]:
+        delta["dead"] = dead
+
+    # food is only removed in place and appended to
+    food, kept, eaten = state["food"], 0, []
+    for item in previous["food"]:
+        if kept < len(food) and list(food[kept]) == list(item):
+            kept += 1
+        else:
+            eaten.append([item[0], item[1]])
+    if eaten:
+        delta["eaten"] = eaten
+    if kept < len(food):
+        delta["spawned"] = [list(item) for item in food[kept:]]
+
+    return {"step": state["step"], "delta": delta}
+
+
+def apply_delta(previous, frame):
+    """Rebuild the viewer frame following previous from a delta frame."""
+    delta = frame["delta"]
+    changed = delta.get("snakes", {})
+    dead = set(delta.get("dead", ()))
+
+    snakes = []
+    for snake in previous["snakes"]:
+        if snake["name"] in dead:
+            continue
+        changes = changed.get(snake["name"])
+        if changes:
+            snake = dict(snake)
+            if "body" in changes:
+                snake["body"] = changes["body"]
+            elif "head" in changes:
+                body = snake["body"]
+                snake["body"] = changes["head"] + body[: len(body) - changes["tail"]]
+            for key in ("score", "range", "traverse"):
+                if key in changes:
+                    snake[key] = changes[key]
+        snakes.append(snake)
+    known = {snake["name"] for snake in snakes}
+    for name, changes in changed.items():
+        if name not in known:
+            snakes.append({"name": name, **changes})
+
+    eaten = {tuple(cell) for cell in delta.get("eaten", ())}
+    food = [item for item in previous["food"] if (item[0], item[1]) not in eaten]
+    food += delta.get("spawned", [])
+
+    return {
+        "food": food,
+        "players": previous["players"],
+        "step": frame["step"],
+        "timeout": previous["timeout"],
+        "snakes": snakes,
+    }
+
+
+def loads(message):
+    """Decode a message from the server, binary frame or JSON text."""
+    if isinstance(message, bytes):
+        return decode(message)
+    return json.loads(message)
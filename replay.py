@@ -0,0 +1,210 @@
+"""Compact binary replay logs of games, and their re-simulation.
+
+A replay holds the seed, the generated map and the key each snake had
+pressed at every step, one byte per snake per step. Keyframes with every
+snake's score, length and head are written every KEYFRAME_INTERVAL steps
+and at the end, so a replay also checks that the engine still produces the
+same game.
+
+Layout (little endian):
+    header   "SNKR" version:B seed:Q width:H height:H timeout:I players:B
+             players x (len:B name:utf8) map_len:I zlib(map tiles)
+    step     "S" players x key:B
+    keyframe "K" step:I players x (score:i alive:B length:H x:H y:H)
+"""
+import argparse
+import logging
+import struct
+import zlib
+
+from game import Game
+
+logger = logging.getLogger("Replay")
+logger.setLevel(logging.INFO)
+
+MAGIC = b"SNKR"
+VERSION = 1
+KEYFRAME_INTERVAL = 100
+
+HEADER = struct.Struct("<4sBQHHIB")
+KEYFRAME = struct.Struct("<I")
+SNAKE_FRAME = struct.Struct("<iBHHH")
+STEP_TAG = b"S"
+KEYFRAME_TAG = b"K"
+INVALID_KEY = 0xFF  # keys that do not fit a byte are invalid anyway
+MAX_PLAYERS = 0xFF
+MAX_NAME_BYTES = 0xFF  # of a player name in utf8
+
+
+class ReplayMismatch(Exception):
+    """The re-simulated game differs from the recorded one."""
+
+
+def encode_key(key):
+    if key == "":
+        return 0
+    code = ord(key[0])
+    return code if code < INVALID_KEY else INVALID_KEY
+
+
+def decode_key(code):
+    return chr(code) if code else ""
+
+
+def map_bytes(game):
+    return bytes(tile for column in game.map.export() for tile in column)
+
+
+def keyframe(game):
+    """Step and per snake (score, alive, length, head x, head y)."""
+    return game._step, [
+        (snake.score, snake.alive, len(snake._body), *snake.head)
+        for snake in game.snakes.values()
+    ]
+
+
+class ReplayRecorder:
+    """Write the replay of a game as it is played.
+
+    Set it as the recorder of a Game before calling Game.start().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def start(self, game):
+        names = [name.encode() for name in game.snakes]
+        if len(names) > MAX_PLAYERS or any(len(n) > MAX_NAME_BYTES for n in names):
+            raise ValueError("Players do not fit a replay header")
+        self._file = open(self.path, "wb")
+        width, height = game.map.size
+        self._file.write(
+            HEADER.pack(MAGIC, VERSION, game.seed, width, height, game._timeout, len(names))
+        )
+        for name in names:
+            self._file.write(bytes([len(name)]) + name)
+        tiles = zlib.compress(map_bytes(game))
+        self._file.write(struct.pack("<I", len(tiles)) + tiles)
+
+    def record_step(self, game):
+        """Record the keys used by the step about to be played."""
+        self._file.write(
+            STEP_TAG + bytes(encode_key(snake.lastkey) for snake in game.snakes.values())
+        )
+
+    def record_frame(self, game):
+        """Write a keyframe when due, and close the replay once the game ended."""
+        if game._step % KEYFRAME_INTERVAL == 0 or not game.running:
+            step, snakes = keyframe(game)
+            self._file.write(KEYFRAME_TAG + KEYFRAME.pack(step))
+            for snake in snakes:
+                self._file.write(SNAKE_FRAME.pack(*snake))
+        if not game.running:
+            self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_replay(path):
+    """Return (header dict, list of records) of a replay file.
+
+    Records are ("S", keys) and ("K", (step, snakes)) tuples.
+    """
+    with open(path, "rb") as infile:
+        data = infile.read()
+
+    magic, version, seed, width, height, timeout, players = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} replay")
+    offset = HEADER.size
+    names = []
+    for _ in range(players):
+        length = data[offset]
+        names.append(data[offset + 1 : offset + 1 + length].decode())
+        offset += 1 + length
+    (map_len,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    tiles = zlib.decompress(data[offset : offset + map_len])
+    offset += map_len
+
+    records = []
+    while offset < len(data):
+        tag = data[offset : offset + 1]
+        offset += 1
+        if tag == STEP_TAG:
+            records.append(("S", [decode_key(code) for code in data[offset : offset + players]]))
+            offset += players
+        elif tag == KEYFRAME_TAG:
+            (step,) = KEYFRAME.unpack_from(data, offset)
+            offset += KEYFRAME.size
+            snakes = []
+            for _ in range(players):
+                score, alive, length, x, y = SNAKE_FRAME.unpack_from(data, offset)
+                snakes.append((score, bool(alive), length, x, y))
+                offset += SNAKE_FRAME.size
+            records.append(("K", (step, snakes)))
+        else:
+            raise ValueError(f"Corrupted replay {path} at byte {offset - 1}")
+
+    header = {
+        "seed": seed,
+        "size": (width, height),
+        "timeout": timeout,
+        "players": names,
+        "map": tiles,
+    }
+    return header, records
+
+
+def replay(path):
+    """Re-simulate a replay at full speed and return the finished Game.
+
+    Raises ReplayMismatch when the map or a keyframe is not reproduced.
+    """
+    header, records = read_replay(path)
+    game = Game(seed=header["seed"], size=header["size"], timeout=header["timeout"])
+    game.start(header["players"])
+    if map_bytes(game) != header["map"]:
+        raise ReplayMismatch(f"{path}: generated map differs")
+
+    for kind, record in records:
+        if kind == "S":
+            game.step(dict(zip(header["players"], record)))
+        elif keyframe(game) != (record[0], [tuple(snake) for snake in record[1]]):
+            raise ReplayMismatch(
+                f"{path}: step {record[0]} differs, recorded {record} got {keyframe(game)}"
+            )
+    return game
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    # replays reproduce the original games' invalid key errors too
+    logging.getLogger("Game").setLevel(logging.CRITICAL)
+    logging.getLogger("Map").setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("replays", help="Replay files to re-simulate", nargs="+")
+    args = parser.parse_args()
+
+    failed = 0
+    for path in args.replays:
+        try:
+            game = replay(path)
+        except ReplayMismatch as err:
+            logger.error(err)
+            failed += 1
+            continue
+        logger.info(
+            "%s: %s steps, scores %s",
+            path,
+            game._step,
+            {name: snake.score for name, snake in game.snakes.items()},
+        )
+    raise SystemExit(1 if failed else 0)
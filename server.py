@@ -6,17 +6,21 @@ from datetime import datetime
 import json
 import logging
 import os.path
-import random
-from collections import namedtuple
+import struct
+from collections import deque, namedtuple
+from time import perf_counter
 from typing import Any, Dict, Set
 
-import requests
 import websockets
-from requests import RequestException
 from websockets.legacy.protocol import WebSocketCommonProtocol
 
+import metrics
+import protocol
 from game import Game
-from consts import TIMEOUT
+from grading import QUEUE_FILE, GradingUploader
+from highscores import HighscoreStore
+from replay import ReplayRecorder
+from consts import MATCH_PREFIX, TIMEOUT
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -29,12 +33,279 @@ logger.setLevel(logging.INFO)
 
 Player = namedtuple("Player", ["name", "ws"])
 
-HIGHSCORE_FILE = "highscores.json"
-MAX_HIGHSCORES = 10
+OUTBOX_SIZE = 2  # droppable frames queued per client
+FLUSH_TIMEOUT = 1  # seconds to deliver the last frames before disconnecting
+LOBBY = ""  # viewers of /viewer, they follow the newest room
+KEYFRAME_INTERVAL = 50  # ticks between full frames for viewers of deltas
+DELTA = "delta"
+
+GAME_PHASES = metrics.Histogram(
+    "snake_game_phase_seconds", "Time spent in each phase of a game step", ["phase"]
+)
+TICK_SECONDS = metrics.Histogram(
+    "snake_tick_seconds", "Time a room spends on a tick, from step to queued frames"
+)
+ENCODE_SECONDS = metrics.Histogram(
+    "snake_encode_seconds", "Time to encode a frame", ["encoding"]
+)
+SEND_SECONDS = metrics.Histogram(
+    "snake_send_seconds", "Time to hand a frame to a client websocket"
+)
+DROPPED_FRAMES = metrics.Counter(
+    "snake_dropped_frames_total", "Frames superseded before they were sent"
+)
+TICK_OVERRUNS = metrics.Counter(
+    "snake_tick_overruns_total", "Ticks that started after their deadline"
+)
+
+
+class Outbox:
+    """Frames waiting to be sent to a websocket client.
+
+    A drain task sends them in order. When a client reads slower than frames
+    are produced, at most size droppable frames are kept and the oldest ones
+    are superseded by the latest. Delta frames only make sense after the
+    frames they follow, so clients of deltas drop every queued frame instead
+    and wait for a full one.
+    """
+
+    def __init__(
+        self,
+        ws: WebSocketCommonProtocol,
+        name: str,
+        encoding: str = protocol.JSON,
+        deltas: bool = False,
+        size: int = OUTBOX_SIZE,
+    ):
+        self.ws = ws
+        self.name = name
+        self.encoding = encoding  # of the frames sent every tick, see protocol
+        self.deltas = deltas  # client takes delta frames between full ones
+        self.needs_keyframe = True  # next frame must be a full one
+        self.size = size
+        self.dropped = 0  # frames superseded before they were sent
+        self._frames = deque()  # (message, droppable)
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = asyncio.ensure_future(self._drain())
+
+    @property
+    def closed(self):
+        return self._task.done()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, message, droppable=True, delta=False):
+        """Queue a message, superseding the oldest droppable one if full."""
+        if self.closed:
+            return
+        if droppable:
+            queued = [frame for frame in self._frames if frame[1]]
+            if len(queued) >= self.size:
+                superseded = queued if self.deltas else queued[:1]
+                for frame in superseded:
+                    self._frames.remove(frame)
+                self.dropped += len(superseded)
+                DROPPED_FRAMES.inc(amount=len(superseded))
+                logger.debug("<%s> lagging, %s frames dropped", self.name, self.dropped)
+                if delta:  # follows the frames just dropped
+                    self.dropped += 1
+                    DROPPED_FRAMES.inc()
+                    self.needs_keyframe = True
+                    return
+        self._frames.append((message, droppable))
+        self._idle.clear()
+        self._ready.set()
+
+    async def _drain(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self._frames:
+                    message, _ = self._frames.popleft()
+                    start = perf_counter()
+                    await self.ws.send(message)
+                    SEND_SECONDS.observe(perf_counter() - start)
+                self._ready.clear()
+                self._idle.set()
+        except websockets.exceptions.ConnectionClosed:
+            logger.info("<%s> disconnected", self.name)
+        finally:
+            self._frames.clear()
+            self._idle.set()
+
+    async def flush(self, timeout=FLUSH_TIMEOUT):
+        """Wait until every queued frame is sent, or timeout seconds."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("<%s> did not read its last frames", self.name)
+
+    def close(self):
+        self._task.cancel()
+
+
+class Room:
+    """Games played by a group of players, with their own tick task.
+
+    Rooms formed by the matchmaker play a single game, named rooms keep
+    playing games as long as players join them.
+    """
+
+    def __init__(self, server: GameServer, name: str, players: int, games: int = None):
+        self.server = server
+        self.name = name
+        self.number_of_players = players
+        self.games = games  # games to play before closing, None while players join
+        self.game = None
+        self.players: asyncio.Queue[Player] = asyncio.Queue()
+        self.task = None
+
+    @property
+    def viewers(self):
+        """Viewers of this room, and the lobby viewers if it is the newest."""
+        viewers = set(self.server.viewers.get(self.name, ()))
+        if self.server.newest_room == self.name:
+            viewers.update(self.server.viewers.get(LOBBY, ()))
+        return viewers
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.mainloop())
+        return self
+
+    async def wait_players(self):
+        """Wait until enough connected players joined the room.
+
+        Matched rooms get no other players, if one of them left the others
+        go back to matchmaking and None is returned.
+        """
+        game_players = []
+        logger.info("[%s] Waiting for players", self.name)
+        while len(game_players) < self.number_of_players:
+            player = await self.players.get()
+            if player.ws.closed:
+                logger.error("<%s> disconnect while waiting", player.name)
+                if self.games is not None:
+                    while not self.players.empty():
+                        game_players.append(self.players.get_nowait())
+                    for player in game_players:
+                        self.server.player_room.pop(player.ws, None)
+                        self.server.players.put_nowait(player)
+                    return None
+                continue
+            game_players.append(player)
+            self.server.player_room[player.ws] = self
+        return game_players
+
+    async def mainloop(self):
+        """Play games until done, then close the room."""
+        played = 0
+        try:
+            while self.games is None or played < self.games:
+                game_players = await self.wait_players()
+                if game_players is None:
+                    break
+                await self.play(game_players)
+                played += 1
+                if self.games is None and self.players.empty():
+                    break  # nobody waiting for another game
+        finally:
+            logger.info("[%s] Closing room", self.name)
+            if self.server.rooms.get(self.name) is self:
+                del self.server.rooms[self.name]
+
+    async def play(self, game_players):
+        """Run one game."""
+        server = self.server
+        clients = [player.ws for player in game_players]
+        try:
+            logger.info("[%s] Starting game", self.name)
+            self.game = Game(
+                timeout=server._timeout, seed=server.seed if server.seed > 0 else None
+            )
+            if server.replays:
+                self.game.recorder = ReplayRecorder(
+                    os.path.join(
+                        server.replays,
+                        f"{datetime.now():%Y%m%d-%H%M%S}-{self.name}-{self.game.seed}.replay",
+                    )
+                )
+            self.game.metrics = GAME_PHASES
+            self.game.lockstep = server.lockstep
+            self.game.start([p.name for p in game_players])
+
+            previous = None  # last state sent to viewers
+            while self.game.running:
+                if self.game._step == 0:  # Starting a level ? Let's send the info
+                    game_info = self.game.info()
+
+                    await server.send_clients(self.viewers, game_info, droppable=False)
+                    await server.send_clients(clients, game_info, droppable=False)
+
+                overruns = self.game.scheduler.overruns
+                if state := await self.game.next_frame():
+                    start = perf_counter()
+                    if self.game.scheduler.overruns > overruns:
+                        TICK_OVERRUNS.inc()
+                    if self.game._step % KEYFRAME_INTERVAL == 0:
+                        previous = None  # everyone gets a full frame
+                    await server.send_clients(
+                        self.viewers, state, size=self.game.map.size, previous=previous
+                    )
+                    previous = state
+
+                    # players only get their own snake and its sight
+                    player_states = self.game.player_states(
+                        state, [p.name for p in game_players]
+                    )
+
+                    for player in await server.send_players(
+                        game_players, player_states, self.game.map.size
+                    ):
+                        game_players.remove(player)
+                    TICK_SECONDS.observe(perf_counter() - start)
+
+            game_over = {
+                "highscores": await server.save_highscores(
+                    self.game, [p.name for p in game_players]
+                )
+            }
+            await server.send_clients(self.viewers, game_over, droppable=False)
+            await server.send_clients(clients, game_over, droppable=False)
+
+            for client, dropped in server.dropped_frames(clients + list(self.viewers)).items():
+                if dropped:
+                    logger.info("<%s> lagged, %s frames dropped", client, dropped)
+
+        finally:
+            self.game.quit()  # closes the replay of a game that did not end
+            if server.grading is not None:
+                for player in game_players:
+                    if player.name not in self.game.snakes:
+                        continue  # never got a snake
+                    game_record = {
+                        "player": player.name,
+                        "score": self.game.snakes[player.name].score,
+                        "players": self.number_of_players,
+                    }
+                    server.grading.submit(game_record)
+
+            for ws in clients:
+                logger.info("Disconnecting <%s>", server.game_player.get(ws))
+            await asyncio.gather(*(server.close_client(ws) for ws in clients))
 
 
 class GameServer:
-    """Network Game Server."""
+    """Network Game Server.
+
+    Players joining /player are matched into new rooms of `players` players,
+    players joining /player/<room> play in that room. Viewers follow a room
+    on /viewer/<room>, or the newest room on /viewer. Names starting with
+    MATCH_PREFIX are kept for matched rooms, only a supervisor matching
+    players for this server may send players to them.
+    """
 
     def __init__(
         self,
@@ -44,185 +315,264 @@ class GameServer:
         players=1,
         grading: str = None,
         dbg: bool = False,
+        replays: str = None,
+        grading_queue: str = QUEUE_FILE,
+        lockstep: bool = False,
+        supervised: bool = False,
     ):
         """Initialize Gameserver."""
         self.dbg = dbg
+        self.lockstep = lockstep  # tick once every player sent its key
+        self.supervised = supervised  # players of matched rooms come from a supervisor
+        self.replays = replays  # directory to record replays into
         self.seed = seed
-        self.game = Game(timeout=timeout)
-        self.players: asyncio.Queue[Player] = asyncio.Queue()
-        self.viewers: Set[WebSocketCommonProtocol] = set()
-        self.grading = grading
+        self.players: asyncio.Queue[Player] = asyncio.Queue()  # matchmaking queue
+        self.rooms: Dict[str, Room] = {}
+        self.newest_room = None  # name of the room lobby viewers follow
+        self._matches = 0  # rooms formed by the matchmaker
+        self.viewers: Dict[str, Set[WebSocketCommonProtocol]] = {}  # room to viewers
+        self.grading = GradingUploader(grading, grading_queue) if grading else None
         self._level = level  # game level
         self._timeout = timeout  # timeout for game
         self.game_player = {}  # websocket to player mapping
+        self.player_room: Dict[WebSocketCommonProtocol, Room] = {}
+        self.outboxes: Dict[WebSocketCommonProtocol, Outbox] = {}
         self.number_of_players = players
 
-        self._highscores = []
-        if os.path.isfile(HIGHSCORE_FILE):
-            with open(HIGHSCORE_FILE, "r") as infile:
-                self._highscores = json.load(infile)
-
-    def save_highscores(self):
-        """Update highscores, storing to file."""
+        self.highscores = HighscoreStore()
+
+        metrics.Gauge(
+            "snake_waiting_players",
+            "Players waiting in the matchmaking queue",
+            self.players.qsize,
+        )
+        metrics.Gauge(
+            "snake_players", "Players connected", lambda: len(self.game_player)
+        )
+        metrics.Gauge(
+            "snake_viewers",
+            "Viewers connected",
+            lambda: sum(len(viewers) for viewers in self.viewers.values()),
+        )
+        metrics.Gauge("snake_rooms", "Rooms open", lambda: len(self.rooms))
+        metrics.Gauge(
+            "snake_outbox_frames",
+            "Frames queued for clients, not sent yet",
+            lambda: sum(len(outbox) for outbox in self.outboxes.values()),
+        )
+
+    async def save_highscores(self, game, players):
+        """Record the scores of the players of game, return the highscores."""
 
         logger.debug("Save highscores")
-        for player in self.game_player.values():
-            if player not in self.game.snakes:
+        for player in players:
+            if player not in game.snakes:
                 continue
             logger.info(
                 "Saving: %s <%s>",
                 player,
-                self.game.snakes[player].score,
+                game.snakes[player].score,
             )
 
-            self._highscores.append((player, self.game.snakes[player].score))
-            self._highscores = sorted(
-                self._highscores, key=lambda s: s[1], reverse=True
-            )[:MAX_HIGHSCORES]
-
-        with open(HIGHSCORE_FILE, "w") as outfile:
-            json.dump(self._highscores, outfile)
-
-        return self._highscores
-
-    async def send_clients(self, group, info):
-        to_remove = []
-
-        original_group = group
-        if isinstance(group, dict):
-            group = group.keys()
-
-        for client in group:
+            self.highscores.add(player, game.snakes[player].score, len(game.snakes))
+
+        return await self.highscores.top()
+
+    def room(self, name, games=None):
+        """Return the named room, opening it if needed."""
+        if name not in self.rooms:
+            logger.info("[%s] Opening room", name)
+            self.rooms[name] = Room(self, name, self.number_of_players, games).start()
+            self.newest_room = name
+        return self.rooms[name]
+
+    def outbox(self, websocket, name, encoding=protocol.JSON, deltas=False):
+        """Return the outbox of a client, creating it on first use."""
+        if websocket not in self.outboxes:
+            self.outboxes[websocket] = Outbox(websocket, name, encoding, deltas)
+        return self.outboxes[websocket]
+
+    def dropped_frames(self, clients=None):
+        """Frames superseded so far, per client (of clients if given)."""
+        outboxes = self.outboxes.values()
+        if clients is not None:
+            outboxes = [self.outboxes[c] for c in clients if c in self.outboxes]
+        return {outbox.name: outbox.dropped for outbox in outboxes}
+
+    async def send_clients(self, clients, info, droppable=True, size=None, previous=None):
+        """Queue info to every connected client.
+
+        Frames that are not droppable (game info, highscores) are never
+        superseded by newer ones. Game states, of a map of the given size,
+        are sent in the encoding each client asked for, or as a delta from
+        the previous state to clients of deltas that are in sync.
+        """
+        messages = {}  # encode once per encoding for the whole group
+        for client in clients:
+            outbox = self.outboxes.get(client)
+            if outbox is None:
+                continue
+            if previous is not None and outbox.deltas and not outbox.needs_keyframe:
+                if DELTA not in messages:
+                    start = perf_counter()
+                    messages[DELTA] = json.dumps(protocol.state_delta(previous, info))
+                    ENCODE_SECONDS.observe(perf_counter() - start, DELTA)
+                outbox.put(messages[DELTA], droppable, delta=True)
+                continue
+            encoding = outbox.encoding if size is not None else protocol.JSON
+            if encoding not in messages:
+                start = perf_counter()
+                try:
+                    if encoding == protocol.BINARY:
+                        messages[encoding] = protocol.encode_state(info, size)
+                    else:
+                        messages[encoding] = json.dumps(info)
+                except (ValueError, struct.error) as err:
+                    logger.error("Could not encode a frame as %s: %s", encoding, err)
+                    messages[encoding] = None
+                ENCODE_SECONDS.observe(perf_counter() - start, encoding)
+            if messages[encoding] is None:
+                continue
+            outbox.put(messages[encoding], droppable)
+            if size is not None:
+                outbox.needs_keyframe = False
+
+    async def send_players(self, players, player_states, size):
+        """Queue every player its own state, return the players that are gone.
+
+        A player reading slower than the tick rate gets its stale frames
+        replaced by newer ones instead of holding back the game.
+        """
+        ts = datetime.now().isoformat()
+        gone = []
+        for player in players:
+            outbox = self.outboxes.get(player.ws)
+            if outbox is None or outbox.closed:
+                logger.error("Player <%s> disconnected, could not send state", player.name)
+                gone.append(player)
+                continue
+            player_state = player_states[player.name]
+            player_state["ts"] = ts
+            start = perf_counter()
             try:
-                await client.send(json.dumps(info))
-            except Exception:
-                to_remove.append(client)
-                await client.close()
-        for client in to_remove:
-            if isinstance(original_group, dict):
-                del original_group[client]        
-            else:
-                original_group.remove(client)
+                if outbox.encoding == protocol.BINARY:
+                    message = protocol.encode_player_state(player_state, size)
+                else:
+                    message = json.dumps(player_state)
+            except (ValueError, struct.error) as err:
+                logger.error("Could not encode the state of <%s>: %s", player.name, err)
+                continue
+            ENCODE_SECONDS.observe(perf_counter() - start, outbox.encoding)
+            outbox.put(message)
+        return gone
+
+    async def close_client(self, websocket):
+        """Flush what is left in the outbox of a client and disconnect it."""
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            await outbox.flush()
+            outbox.close()
+        await websocket.close()
 
     async def incomming_handler(self, websocket: WebSocketCommonProtocol, path: str):
         """Process new clients arriving at the server."""
+        kind, _, room_name = path.lstrip("/").partition("/")
+        watching = None  # room a viewer follows
         try:
             async for message in websocket:
                 data = json.loads(message)
                 if "cmd" not in data:
                     continue
                 if data["cmd"] == "join":
-                    if path == "/player":
+                    room = None
+                    encoding = data.get("encoding", protocol.JSON)
+                    if encoding not in protocol.ENCODINGS:
+                        logger.error("Unknown encoding <%s>", encoding)
+                        await websocket.close()
+                        continue
+                    if kind == "player":
                         if data["name"] in self.game_player.values():
                             logger.error("Player <%s> already exists", data["name"])
                             await websocket.close()
                             continue
-                        logger.info("<%s> has joined", data["name"])
-                        await self.players.put(Player(data["name"], websocket))
+                        if len(data["name"].encode()) > protocol.MAX_NAME_BYTES:
+                            logger.error("Player name <%.20s...> too long", data["name"])
+                            await websocket.close()
+                            continue
+                        matched = room_name.startswith(MATCH_PREFIX)
+                        if matched and not self.supervised:
+                            logger.error("Room <%s> is reserved for matches", room_name)
+                            await websocket.close()
+                            continue
+                        logger.info("<%s> has joined %s", data["name"], room_name or "matchmaking")
+                        self.outbox(websocket, data["name"], encoding)
                         self.game_player[websocket] = data["name"]
-
-                    if path == "/viewer":
-                        logger.info("Viewer connected")
-                        self.viewers.add(websocket)
-
-                    if self.game.running:
-                        game_info = self.game.info()
-                        await websocket.send(json.dumps(game_info))
+                        player = Player(data["name"], websocket)
+                        if room_name:
+                            room = self.room(room_name, games=1 if matched else None)
+                            room.players.put_nowait(player)
+                        else:
+                            self.players.put_nowait(player)
+
+                    if kind == "viewer":
+                        logger.info("Viewer connected to %s", room_name or "lobby")
+                        self.outbox(
+                            websocket,
+                            f"viewer {websocket.remote_address}",
+                            encoding,
+                            data.get("deltas", False),
+                        )
+                        watching = room_name or LOBBY
+                        self.viewers.setdefault(watching, set()).add(websocket)
+                        room = self.rooms.get(room_name or self.newest_room)
+
+                    if room and room.game and room.game.running:
+                        game_info = room.game.info()
+                        self.outboxes[websocket].put(json.dumps(game_info), droppable=False)
 
                 if data["cmd"] == "key":
                     logger.debug((self.game_player[websocket], data))
-                    if len(data["key"]) > 0:
-                        self.game.keypress(self.game_player[websocket], data["key"][0])
-                    else:
-                        self.game.keypress(self.game_player[websocket], "")
+                    room = self.player_room.get(websocket)
+                    name = self.game_player[websocket]
+                    if (
+                        room is None
+                        or room.game is None
+                        or not room.game.running
+                        or name not in room.game.snakes
+                    ):
+                        continue  # still waiting for a game
+                    key = data["key"][0] if len(data["key"]) > 0 else ""
+                    room.game.keypress(name, key, data.get("step"))
 
         except websockets.exceptions.ConnectionClosed as closed_reason:
             logger.info("Client disconnected: %s", closed_reason)
-            if websocket in self.viewers:
-                self.viewers.remove(websocket)
+        finally:
+            if watching is not None:
+                self.viewers[watching].discard(websocket)
+                if not self.viewers[watching]:
+                    del self.viewers[watching]
+            self.game_player.pop(websocket, None)
+            self.player_room.pop(websocket, None)
+            if (outbox := self.outboxes.pop(websocket, None)) is not None:
+                outbox.close()
 
     async def mainloop(self):
-        """Run the game."""
+        """Match players waiting on /player into new rooms."""
+        if self.grading is not None:
+            self.grading.start()
         while True:
             game_players = []
-            logger.info("Waiting for players")
             while len(game_players) < self.number_of_players:
                 game_players.append(await self.players.get())
+                # players may leave while the others are awaited
+                for player in [p for p in game_players if p.ws.closed]:
+                    logger.error("<%s> disconnect while waiting", player.name)
+                    game_players.remove(player)
 
-                if game_players[-1].ws.closed:
-                    logger.error("<%s> disconnect while waiting", game_players[-1].name)
-                    continue
-
-            try:
-                logger.info("Starting game")
-                if self.seed > 0:
-                    random.seed(self.seed)
-
-                self.game = Game(timeout=self._timeout)
-                self.game.start([p.name for p in game_players])
-
-                while self.game.running:
-                    if self.game._step == 0:  # Starting a level ? Let's send the info
-                        game_info = self.game.info()
-
-                        await self.send_clients(self.viewers, game_info)
-                        await self.send_clients(self.game_player, game_info)
-
-                    if state := await self.game.next_frame():
-                        await self.send_clients(self.viewers, state)
-
-                        snakes = state["snakes"]
-                        del state[
-                            "snakes"
-                        ]  # remove snakes from state as we only send our snake sight
-                        del state[
-                            "food"
-                        ]  # remove food from state as we only send our snake sight
-
-                        for player in game_players:
-                            state["ts"] = datetime.now().isoformat()
-                            for player_snake in snakes:
-                                if player_snake["name"] == player.name:
-                                    state = {**state, **player_snake}
-                            try:
-                                await player.ws.send(json.dumps(state))
-                            except Exception as e:
-                                logger.error(
-                                    "Player <%s> disconnected, could not send state",
-                                    player.name,
-                                )
-                                game_players.remove(player)
-
-                game_over = {"highscores": self.save_highscores()}
-                await self.send_clients(self.viewers, game_over)
-                await self.send_clients(self.game_player, game_over)
-
-                for ws, player in self.game_player.items():
-                    await ws.close()
-                self.game_player = {}
-
-            except websockets.exceptions.ConnectionClosed as ws_closed:
-                if ws_closed in self.game_player:
-                    self.game_player.pop(ws_closed)
-                logger.error("Player disconnected: %s", ws_closed)
-            finally:
-                try:
-                    if self.grading:
-                        for player in game_players:
-                            game_record = {
-                                "player": player.name,
-                                "score": self.game.snakes[player.name].score,
-                                "players": self.number_of_players, 
-                            }
-                            requests.post(self.grading, json=game_record, timeout=2)
-                except RequestException as err:
-                    logger.error(err)
-                    logger.warning("Could not save score to server")
-
-                for ws, player in self.game_player.items():
-                    logger.info("Disconnecting <%s>", player)
-                    await ws.close()
-                self.game_player = {}
+            self._matches += 1
+            room = self.room(f"{MATCH_PREFIX}{self._matches}", games=1)
+            for player in game_players:
+                room.players.put_nowait(player)
 
 
 if __name__ == "__main__":
@@ -239,13 +589,83 @@ if __name__ == "__main__":
         help="url of grading server",
         default="http://tetriscores.av.it.pt/game",
     )
+    parser.add_argument(
+        "--grading-queue",
+        help="File of game records waiting to be uploaded",
+        default=QUEUE_FILE,
+    )
+    parser.add_argument("--replays", help="Directory to record game replays into")
+    parser.add_argument(
+        "--workers",
+        help="Worker processes hosting the rooms, behind this one",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--supervised",
+        help="Take the players of matched rooms from a supervisor (set for workers)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--lockstep",
+        help="Tick as soon as every player answered the last frame, at most one period apart",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="Serve metrics on localhost:<port>/metrics (workers use the next ports)",
+        type=int,
+    )
     args = parser.parse_args()
+    if args.replays:
+        os.makedirs(args.replays, exist_ok=True)
+
+    if args.workers > 1:
+        from supervisor import Supervisor
+
+        worker_args = [
+            "--seed",
+            str(args.seed),
+            "--players",
+            str(args.players),
+            "--grading-server",
+            args.grading_server,
+            "--grading-queue",  # one queue file per worker
+            os.path.join(
+                os.path.dirname(args.grading_queue),
+                "{port}-" + os.path.basename(args.grading_queue),
+            ),
+        ]
+        if args.replays:
+            worker_args += ["--replays", args.replays]
+        if args.debug:
+            worker_args.append("--debug")
+        if args.lockstep:
+            worker_args.append("--lockstep")
+        supervisor = Supervisor(
+            args.workers, args.port, args.players, worker_args, args.metrics_port
+        )
+        asyncio.run(supervisor.serve(args.bind, args.port))
+        raise SystemExit
 
     async def main():
         """Start server tasks."""
-        g = GameServer(0, TIMEOUT, args.seed, args.players, args.grading_server, args.debug)
+        g = GameServer(
+            0,
+            TIMEOUT,
+            args.seed,
+            args.players,
+            args.grading_server,
+            args.debug,
+            args.replays,
+            args.grading_queue,
+            args.lockstep,
+            args.supervised,
+        )
 
         game_loop_task = asyncio.ensure_future(g.mainloop())
+        if args.metrics_port:
+            await metrics.serve(args.metrics_port)
 
         logger.info("Listenning @ %s:%s", args.bind, args.port)
         websocket_server = websockets.serve(g.incomming_handler, args.bind, args.port)
@@ -7,45 +7,69 @@ import asyncio
 import json
 import os
 import websockets
+import protocol
 from map_knowledge import MapKnowledge
 from state_manager import StateManager
 from movement import Movement
 from consts import Tiles
 
-async def agent_loop(server_address="localhost:8000", agent_name="Roldão"):
-    async with websockets.connect(f"ws://{server_address}/player") as websocket:
-        await websocket.send(json.dumps({"cmd": "join", "name": agent_name}))
+class Agent:
+    def __init__(self, game_info, agent_name="Roldão", **movement_options):
+        """
+        Build the agent's knowledge from the game information sent on join.
+        Extra options are passed to Movement, e.g. history_len.
+        """
+        self.name = agent_name
+        map_size = tuple(game_info.get("size", (48, 24)))
+        map_data = game_info.get("map", [[Tiles.PASSAGE.value] * map_size[1] for _ in range(map_size[0])])
+        self.map_knowledge = MapKnowledge(map_size=map_size, map_data=map_data)
+        self.state_manager = StateManager(self.map_knowledge)
+        self.movement = Movement(self.state_manager, self.map_knowledge, **movement_options)
 
-        initial_state = json.loads(await websocket.recv())
+    def decide(self, state):
+        """
+        Update the agent with a new state and return the key to send.
+        """
+        snake_info = {
+            "name": state.get("name", self.name),
+            "body": [list(part) for part in state.get("body", [])],
+            "range": state.get("range", 0),
+            "sight": state.get("sight", {}),
+            "step": state.get("step", 0),
+            "score": state.get("score", 0),
+            "traverse": state.get("traverse", True)
+        }
 
-        map_size = tuple(initial_state.get("size", (48, 24)))
-        map_data = initial_state.get("map", [[Tiles.PASSAGE.value] * map_size[1] for _ in range(map_size[0])])
-        map_knowledge = MapKnowledge(map_size=map_size, map_data=map_data)
-        state_manager = StateManager(map_knowledge)
-        movement = Movement(state_manager, map_knowledge)
+        # Decide move with opponent info
+        next_move = self.movement.decide_move(snake_info)
 
-        while True:
-            try:
-                state = json.loads(await websocket.recv())
+        self.map_knowledge.update_map(snake_info, snake_info["step"])
+        self.state_manager.evaluate_state(snake_info)
+        next_move = self.movement.decide_move(snake_info)
+
+        return next_move
 
-                snake_info = {
-                    "name": state.get("name", agent_name),
-                    "body": state.get("body", []),
-                    "range": state.get("range", 0),
-                    "sight": state.get("sight", {}),
-                    "step": state.get("step", 0),
-                    "score": state.get("score", 0),
-                    "traverse": state.get("traverse", True)
-                }
 
-                # Decide move with opponent info
-                next_move = movement.decide_move(snake_info)
+async def agent_loop(
+    server_address="localhost:8000", agent_name="Roldão", room=None, encoding=protocol.JSON
+):
+    path = f"/player/{room}" if room else "/player"
+    async with websockets.connect(f"ws://{server_address}{path}") as websocket:
+        await websocket.send(
+            json.dumps({"cmd": "join", "name": agent_name, "encoding": encoding})
+        )
 
-                map_knowledge.update_map(snake_info, snake_info["step"])
-                state_manager.evaluate_state(snake_info)
-                next_move = movement.decide_move(snake_info)
+        initial_state = protocol.loads(await websocket.recv())
+        agent = Agent(initial_state, agent_name)
+
+        while True:
+            try:
+                state = protocol.loads(await websocket.recv())
+                next_move = agent.decide(state)
 
-                await websocket.send(json.dumps({"cmd": "key", "key": next_move}))
+                await websocket.send(
+                    json.dumps({"cmd": "key", "key": next_move, "step": state.get("step")})
+                )
 
             except websockets.exceptions.ConnectionClosedOK:
                 print("Server has cleanly disconnected.")
@@ -61,6 +85,8 @@ if __name__ == "__main__":
     SERVER = os.environ.get("SERVER", "localhost")
     PORT = os.environ.get("PORT", "8000")
     NAME = os.environ.get("NAME", "student_agent")
+    ROOM = os.environ.get("ROOM")  # unset: join matchmaking
+    ENCODING = os.environ.get("ENCODING", protocol.JSON)  # or binary
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(agent_loop(f"{SERVER}:{PORT}", NAME))
+    loop.run_until_complete(agent_loop(f"{SERVER}:{PORT}", NAME, ROOM, ENCODING))
@@ -0,0 +1,200 @@
+"""Front door spreading the rooms of a game server over worker processes.
+
+Every worker is a plain server.py listening on a local port. The front
+process reads the join message of each client, picks the worker of the
+room it asks for (the least loaded one for new rooms) and then proxies the
+websocket to it. Players joining /player are matched here and sent to a
+fresh room, so a match never spans two workers. Clients may not join
+matched rooms themselves.
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+
+import websockets
+
+from consts import MATCH_PREFIX
+
+logger = logging.getLogger("Supervisor")
+logger.setLevel(logging.INFO)
+
+WORKER_HOST = "127.0.0.1"
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+STARTUP_TIMEOUT = 10  # seconds for a worker to start listening
+RESTART_DELAY = 1  # seconds before restarting a worker that died
+
+
+class Worker:
+    """A server.py process and the clients proxied to it."""
+
+    def __init__(self, port, args):
+        self.port = port
+        self.args = args  # extra command line arguments of server.py, {port} is replaced
+        self.load = 0  # clients proxied to this worker
+        self.process = None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            SERVER_SCRIPT,
+            "--bind",
+            WORKER_HOST,
+            "--port",
+            str(self.port),
+            "--supervised",
+            *(arg.replace("{port}", str(self.port)) for arg in self.args),
+        )
+        logger.info("Worker %s started on port %s", self.process.pid, self.port)
+
+    async def wait_ready(self):
+        """Wait until the worker accepts connections."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STARTUP_TIMEOUT
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(WORKER_HOST, self.port)
+                writer.close()
+                return
+            except OSError:
+                if loop.time() > deadline:
+                    raise RuntimeError(f"Worker on port {self.port} did not start")
+                await asyncio.sleep(0.1)
+
+    async def supervise(self):
+        """Restart the worker whenever it exits."""
+        while True:
+            code = await self.process.wait()
+            logger.error("Worker on port %s exited with %s, restarting", self.port, code)
+            await asyncio.sleep(RESTART_DELAY)
+            await self.start()
+
+
+class Supervisor:
+    """Proxy clients to worker servers, keeping each room on one worker."""
+
+    def __init__(self, workers, port, players=1, worker_args=(), metrics_port=None):
+        self.workers = [Worker(port + 1 + i, list(worker_args)) for i in range(workers)]
+        if metrics_port:  # every worker serves its own metrics
+            for i, worker in enumerate(self.workers):
+                worker.args += ["--metrics-port", str(metrics_port + 1 + i)]
+        self.number_of_players = players
+        self.rooms = {}  # room -> [worker, connections]
+        self.newest_room = None
+        self._waiting = []  # (websocket, future) of players waiting for a match
+        self._matches = 0
+
+    def route(self, room):
+        """Return the worker of room, assigning it to the least loaded one."""
+        if room not in self.rooms:
+            worker = min(self.workers, key=lambda w: w.load)
+            self.rooms[room] = [worker, 0]
+            self.newest_room = room
+            logger.info("Room %s on worker %s", room, worker.port)
+        entry = self.rooms[room]
+        entry[1] += 1
+        entry[0].load += 1
+        return entry[0]
+
+    def release(self, room):
+        entry = self.rooms[room]
+        entry[1] -= 1
+        entry[0].load -= 1
+        if entry[1] == 0:
+            del self.rooms[room]
+
+    def match(self, websocket):
+        """Queue a player, return a future set to its room once matched."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((websocket, future))
+        if len(self._waiting) >= self.number_of_players:
+            self._matches += 1
+            room = f"{MATCH_PREFIX}front-{self._matches}"  # apart from worker matches
+            for _, f in self._waiting[: self.number_of_players]:
+                f.set_result(room)
+            del self._waiting[: self.number_of_players]
+        return future
+
+    async def incomming_handler(self, websocket, path):
+        """Route a new client to a worker and proxy its messages."""
+        try:
+            join = await websocket.recv()
+        except websockets.exceptions.ConnectionClosed:
+            return
+
+        kind, _, room = path.lstrip("/").partition("/")
+        if kind == "player" and room.startswith(MATCH_PREFIX):
+            logger.error("Room <%s> is reserved for matches", room)
+            await websocket.close()
+            return
+        if kind == "player" and not room:
+            matched = self.match(websocket)
+            closed = asyncio.ensure_future(websocket.wait_closed())
+            await asyncio.wait([matched, closed], return_when=asyncio.FIRST_COMPLETED)
+            closed.cancel()
+            if not matched.done():  # left while waiting
+                self._waiting = [(ws, f) for ws, f in self._waiting if f is not matched]
+                return
+            room = matched.result()
+        if not room:  # lobby viewers follow the newest room
+            worker = self.workers[0]
+            if self.newest_room in self.rooms:
+                worker = self.rooms[self.newest_room][0]
+            await self.proxy(websocket, worker, path, join)
+            return
+
+        worker = self.route(room)
+        try:
+            await self.proxy(websocket, worker, f"/{kind}/{room}", join)
+        finally:
+            self.release(room)
+
+    async def proxy(self, websocket, worker, path, join):
+        try:
+            async with websockets.connect(
+                f"ws://{WORKER_HOST}:{worker.port}{path}", max_size=None
+            ) as upstream:
+                await upstream.send(join)
+                pumps = [
+                    asyncio.ensure_future(pump(websocket, upstream)),
+                    asyncio.ensure_future(pump(upstream, websocket)),
+                ]
+                done, pending = await asyncio.wait(
+                    pumps, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in pending:
+                    task.cancel()
+        except (OSError, websockets.exceptions.WebSocketException) as err:
+            logger.error("Could not reach worker on port %s: %s", worker.port, err)
+        await websocket.close()
+
+    async def serve(self, bind, port):
+        # stop the workers too when terminated
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, asyncio.current_task().cancel
+        )
+        for worker in self.workers:
+            await worker.start()
+        for worker in self.workers:
+            await worker.wait_ready()
+
+        logger.info("Listenning @ %s:%s with %s workers", bind, port, len(self.workers))
+        try:
+            async with websockets.serve(self.incomming_handler, bind, port, max_size=None):
+                await asyncio.gather(*(worker.supervise() for worker in self.workers))
+        except asyncio.CancelledError:
+            logger.info("Stopping workers")
+        finally:
+            for worker in self.workers:
+                if worker.process.returncode is None:
+                    worker.process.terminate()
+
+
+async def pump(source, destination):
+    """Forward messages until either side closes."""
+    try:
+        async for message in source:
+            await destination.send(message)
+    except websockets.exceptions.ConnectionClosed:
+        pass
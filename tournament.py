@@ -0,0 +1,139 @@
+"""Tournament runner that plays many seeded games on a process pool."""
+import argparse
+import ast
+import logging
+import os
+import random
+import statistics
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from arena import play
+from consts import TIMEOUT
+
+logger = logging.getLogger("Tournament")
+logger.setLevel(logging.INFO)
+
+PERCENTILES = (10, 50, 90)
+
+
+def play_seed(seed, config_index, agent_options, players, timeout):
+    """Play one game in a worker process and return its per-player results."""
+    # keep worker logs quiet, one game per core easily produces GBs of debug
+    logging.getLogger("Game").setLevel(logging.WARNING)
+    logging.getLogger("Map").setLevel(logging.WARNING)
+    logging.getLogger("Arena").setLevel(logging.WARNING)
+
+    random.seed(seed)  # agents still draw from the global random module
+    names = [f"agent{i}" for i in range(players)]
+    start = time.perf_counter()
+    game = play(names, agent_options, timeout=timeout, seed=seed)
+
+    return {
+        "seed": seed,
+        "config": config_index,
+        "elapsed": time.perf_counter() - start,
+        "players": [
+            {
+                "name": name,
+                "score": snake.score,
+                "survival": snake.died_at if snake.died_at is not None else game._step,
+                "cause": snake.death_cause or "alive",
+            }
+            for name, snake in game.snakes.items()
+        ],
+    }
+
+
+def summarize(values):
+    """Return mean and percentiles of a list of numbers."""
+    if len(values) > 1:
+        cuts = statistics.quantiles(values, n=100, method="inclusive")
+        percentiles = {p: cuts[p - 1] for p in PERCENTILES}
+    else:
+        percentiles = {p: values[0] for p in PERCENTILES}
+    return {"mean": statistics.fmean(values), **{f"p{p}": v for p, v in percentiles.items()}}
+
+
+def run_tournament(seeds, configs, players=1, workers=None, timeout=TIMEOUT):
+    """Play every seed against every agent config and aggregate the results.
+
+    configs is a list of dicts of Agent options. Returns one summary per
+    config with score and survival statistics and a count of death causes.
+    """
+    results = defaultdict(list)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(play_seed, seed, index, config, players, timeout)
+            for index, config in enumerate(configs)
+            for seed in seeds
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result["config"]].append(result)
+            logger.info(
+                "config=%s seed=%s %.1fs %s",
+                result["config"],
+                result["seed"],
+                result["elapsed"],
+                [(p["name"], p["score"], p["cause"]) for p in result["players"]],
+            )
+
+    summaries = []
+    for index, config in enumerate(configs):
+        player_results = [p for result in results[index] for p in result["players"]]
+        summaries.append(
+            {
+                "config": config,
+                "games": len(results[index]),
+                "score": summarize([p["score"] for p in player_results]),
+                "survival": summarize([p["survival"] for p in player_results]),
+                "causes": Counter(p["cause"] for p in player_results),
+            }
+        )
+    return summaries
+
+
+def parse_config(text):
+    """Parse 'key=value,key=value' into a dict of Agent options."""
+    config = {}
+    for item in filter(None, text.split(",")):
+        key, value = item.split("=", 1)
+        config[key.strip()] = ast.literal_eval(value.strip())
+    return config
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seeds", help="Number of seeds", type=int, default=10)
+    parser.add_argument("--first-seed", help="First seed number", type=int, default=1)
+    parser.add_argument("--players", help="Number of players", type=int, default=1)
+    parser.add_argument("--timeout", help="Steps per game", type=int, default=TIMEOUT)
+    parser.add_argument(
+        "--workers", help="Worker processes", type=int, default=os.cpu_count()
+    )
+    parser.add_argument(
+        "--config",
+        help="Agent options, e.g. history_len=20 (repeat to compare configs)",
+        action="append",
+        type=parse_config,
+    )
+    args = parser.parse_args()
+
+    seeds = range(args.first_seed, args.first_seed + args.seeds)
+    for summary in run_tournament(
+        seeds, args.config or [{}], args.players, args.workers, args.timeout
+    ):
+        logger.info(
+            "%s: %s games, score %s, survival %s, causes %s",
+            summary["config"],
+            summary["games"],
+            {k: round(v, 1) for k, v in summary["score"].items()},
+            {k: round(v, 1) for k, v in summary["survival"].items()},
+            dict(summary["causes"]),
+        )
@@ -7,6 +7,7 @@ import sys
 import pprint
 
 from consts import Tiles
+import protocol
 import pygame
 import websockets
 
@@ -56,7 +57,7 @@ async def main(SCALE):
             await asyncio.sleep(0.1)
 
     logging.debug("Initial game status: %s", state)
-    newgame_json = json.loads(state)
+    newgame_json = protocol.loads(state)
 
     new_game = True
     GAME_SPEED = newgame_json["fps"]
@@ -70,6 +71,7 @@ async def main(SCALE):
     food_sprites = pygame.sprite.Group()
     stone_sprites = pygame.sprite.Group()
     prev_foods = None
+    frame = None  # last full game state, deltas apply to it
 
     step_info = Info(text="0")
 
@@ -77,10 +79,15 @@ async def main(SCALE):
         should_quit()
 
         try:
-            state = json.loads(q.get_nowait())
+            state = protocol.loads(q.get_nowait())
+            if "delta" in state:
+                if frame is None:
+                    continue  # joined between full frames
+                state = protocol.apply_delta(frame, state)
             pprint.pprint(state)
 
             if "snakes" in state and "food" in state:
+                frame = state
                 snakes_update = state["snakes"]
                 print("Snake info:",snakes_update)
                 foods_update = state["food"]
@@ -226,9 +233,11 @@ async def main(SCALE):
         pygame.display.flip()
 
 
-async def messages_handler(ws_path, queue):
+async def messages_handler(ws_path, queue, encoding=protocol.JSON, deltas=False):
     async with websockets.connect(ws_path) as websocket:
-        await websocket.send(json.dumps({"cmd": "join"}))
+        await websocket.send(
+            json.dumps({"cmd": "join", "encoding": encoding, "deltas": deltas})
+        )
 
         while True:
             r = await websocket.recv()
@@ -245,6 +254,16 @@ if __name__ == "__main__":
         "--scale", help="reduce size of window by x times", type=int, default=1
     )
     parser.add_argument("--port", help="TCP port", type=int, default=PORT)
+    parser.add_argument("--room", help="Room to watch (default: the newest one)")
+    parser.add_argument(
+        "--encoding",
+        help="Encoding of game frames",
+        choices=protocol.ENCODINGS,
+        default=protocol.JSON,
+    )
+    parser.add_argument(
+        "--deltas", help="Receive only what changed between frames", action="store_true"
+    )
     args = parser.parse_args()
     SCALE = 32 * (1 / args.scale)
 
@@ -254,10 +273,15 @@ if __name__ == "__main__":
     q: asyncio.Queue = asyncio.Queue()
 
     ws_path = f"ws://{args.server}:{args.port}/viewer"
+    if args.room:
+        ws_path += f"/{args.room}"
 
     try:
         LOOP.run_until_complete(
-            asyncio.gather(messages_handler(ws_path, q), main_loop(q, SCALE=SCALE))
+            asyncio.gather(
+                messages_handler(ws_path, q, args.encoding, args.deltas),
+                main_loop(q, SCALE=SCALE),
+            )
         )
     finally:
         LOOP.stop()